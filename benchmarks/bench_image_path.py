@@ -0,0 +1,144 @@
+"""
+Image path benchmark against the local mock SD WebUI (lib/sd_api/mock_server.py).
+
+Reports throughput and p50/p95/p99 latency of WebUIApi, APIQueue and
+G4FClient.generate_image for every concurrency level:
+
+    python -m benchmarks.bench_image_path --concurrency 1,4,16 --latency 0.2 --slots 2
+
+G4FClient needs g4f installed. Failed SD requests go to its fallback image
+provider, so keep --failure-rate 0 for it unless measuring the fallback.
+"""
+
+import argparse, asyncio, logging, sys, time
+
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from lib.sd_api.api_models import txt2img_params
+from lib.sd_api.sd_api import WebUIApi, APIQueue
+from lib.sd_api.mock_server import MockWebUI
+
+
+@dataclass
+class Result:
+    target: str
+    concurrency: int
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0.0
+
+    def percentile(self, p: float) -> float:
+        """Nearest rank percentile"""
+        if not self.latencies:
+            return float("nan")
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def row(self) -> str:
+        return (f"{self.target:<10} {self.concurrency:>5} {len(self.latencies):>6} {self.errors:>6} {self.throughput:>9.2f}"
+                f" {self.percentile(50):>8.3f} {self.percentile(95):>8.3f} {self.percentile(99):>8.3f}")
+
+HEADER = f"{'target':<10} {'conc':>5} {'ok':>6} {'errors':>6} {'req/s':>9} {'p50':>8} {'p95':>8} {'p99':>8}"
+
+
+def make_params(i: int) -> txt2img_params:
+    params = txt2img_params()
+    params.prompt = f"benchmark image {i}"
+    params.width = 512
+    params.height = 512
+    params.seed = -1 #random seed: nothing is coalesced or cached
+    return params
+
+
+async def run_load(target: str, concurrency: int, requests: int, call: Callable[[int], Awaitable]) -> Result:
+    """`requests` calls with at most `concurrency` in flight"""
+    result = Result(target, concurrency)
+    counter = iter(range(requests))
+
+    async def client():
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                await call(i)
+                result.latencies.append(time.perf_counter() - start)
+            except Exception:
+                result.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+async def bench_webui(port: int, concurrency: int, requests: int) -> Result:
+    async with WebUIApi("127.0.0.1", port) as api:
+        return await run_load("webui", concurrency, requests, lambda i: api.txt2img(make_params(i)))
+
+
+async def bench_queue(port: int, concurrency: int, requests: int, workers: int) -> Result:
+    async with WebUIApi("127.0.0.1", port) as api:
+        queue = APIQueue(workers=workers, max_tasks=requests)
+        task = asyncio.create_task(queue.process_requests())
+        try:
+            return await run_load("queue", concurrency, requests, lambda i: queue.submit(APIQueue.Params(
+                f"user{i % concurrency}", lambda: api.txt2img(make_params(i))
+            )))
+        finally:
+            task.cancel()
+
+
+async def bench_g4f(port: int, concurrency: int, requests: int) -> Result:
+    from lib.ai_client import G4FClient
+    client = G4FClient(model=None, provider=None, image_model=None, image_provider=None,
+                       sd_api=WebUIApi("127.0.0.1", port))
+    await client.open()
+    try:
+        return await run_load("g4f", concurrency, requests, lambda i: client.generate_image(f"benchmark image {i}", uid=f"user{i % concurrency}"))
+    finally:
+        await client.close()
+
+
+async def main(args):
+    server = MockWebUI(args.latency, args.jitter, args.failure_rate, args.payload_kb * 1024, args.slots)
+    port = await server.start()
+    print(f"mock: {args.latency}s/image, {args.slots} slots, {args.payload_kb} KiB images, failure rate {args.failure_rate}")
+    print(HEADER)
+    try:
+        for target in args.targets.split(","):
+            for concurrency in args.concurrency:
+                if target == "webui":
+                    result = await bench_webui(port, concurrency, args.requests)
+                elif target == "queue":
+                    result = await bench_queue(port, concurrency, args.requests, args.slots)
+                elif target == "g4f":
+                    try:
+                        result = await bench_g4f(port, concurrency, args.requests)
+                    except ImportError as E:
+                        print(f"g4f       skipped: {E}")
+                        break
+                else:
+                    raise ValueError(f"Unknown target: {target}")
+                print(result.row())
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default="webui,queue,g4f")
+    parser.add_argument("--concurrency", type=lambda v: [int(x) for x in v.split(",")], default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock seconds per image")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--payload-kb", type=int, default=256)
+    parser.add_argument("--slots", type=int, default=1, help="mock jobs processed at the same time, also queue workers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    asyncio.run(main(args))
@@ -1,96 +1,452 @@
-from typing import List, Dict, Any, Optional
-import base64
-import io
-from PIL import Image
+from typing import AsyncIterator, List, Dict, Any, Optional, Union
+import asyncio
+import json
+import inspect
+import hashlib
 
 from lib.sd_api.api_models import txt2img_params
-from lib.sd_api.sd_api import WebUIApi
+from lib.sd_api.sd_api import WebUIApi, WebUIApiResult, APIQueue, JobCancelled, MaxQueueReached, WebUIHTTPError
+from lib.sd_api.balancer import WebUIPool, NoBackendAvailable, BACKEND_ERRORS
+from lib.sd_api.shared import EncodedImage
+from lib.sd_api.progress import ProgressCallback
+from lib.circuit_breaker import CircuitBreaker, CircuitOpen
+from lib.llm_cache import LLMCache, provider_name
+from lib.provider_router import ProviderRouter
+from lib.rate_limiter import RateLimiter
+
+from dataclasses import dataclass
 
 import logging
 
 logger = logging.getLogger("ai_client")
 
+
+@dataclass(slots=True)
+class ImagePreset:
+    """Resolution and sampling settings of one kind of image"""
+    width: int
+    height: int
+    steps: int = 28
+    cfg_scale: float = 7.0
+    sampler_name: str = "Euler a"
+
+
+DEFAULT_IMAGE_PRESETS = {
+    "landscape": ImagePreset(1216, 832), #bunker
+    "portrait": ImagePreset(832, 1216), #characters
+    "square": ImagePreset(1024, 1024),
+}
+
+
+def _sd_backend_error(E: Exception) -> bool:
+    """SD is down or broken, counts against the circuit breaker"""
+    if isinstance(E, WebUIHTTPError):
+        return E.status >= 500
+    return isinstance(E, BACKEND_ERRORS + (NoBackendAvailable, json.JSONDecodeError))
+
+
+def _sd_request_error(E: Exception) -> bool:
+    """Request itself is wrong (unknown sampler or upscaler, rejected params): a caller bug, no fallback"""
+    if isinstance(E, WebUIHTTPError):
+        return E.status in (400, 422)
+    return isinstance(E, ValueError) and not _sd_backend_error(E)
+
+
+def _partial_images(results: list) -> List[Optional[EncodedImage]]:
+    """gather(return_exceptions=True) of images: failed ones become None, cancellation and caller bugs are raised"""
+    images = []
+    for result in results:
+        if isinstance(result, (JobCancelled, asyncio.CancelledError)) or (isinstance(result, Exception) and _sd_request_error(result)):
+            raise result
+        if isinstance(result, BaseException):
+            logger.error(f"Error generating image: {result!r}")
+            result = None
+        images.append(result)
+    return images
+
+
 class AIClient:
     """Base class for working with LLM."""
+
+    # Some provider handles several items packed into one structured (JSON) request well, see generate_message(batch=True)
+    batch_requests = False
     
-    def __init__(self, model: str = None, provider: Any = None, image_model: str = None, image_provider: Any = None):
+    def __init__(self, model: str = None, provider: Any = None, image_model: str = None, image_provider: Any = None,
+                 sd_api: Union[WebUIApi, WebUIPool] = None, image_presets: Dict[str, ImagePreset] = None, stable_seeds: bool = False,
+                 llm_cache: LLMCache = None, llm_limiter: RateLimiter = None):
         self.model = model
         self.provider = provider
         self.image_model = image_model
         self.image_provider = image_provider
+        # Shared image backend, configured once at startup (None - no SD)
+        self.sd_api = sd_api
+        self.image_presets = {**DEFAULT_IMAGE_PRESETS, **(image_presets or {})}
+        self.stable_seeds = stable_seeds #seed from prompt: same prompt - same image, lets SD cache work
+        self.llm_cache = llm_cache #None - every message goes to the model
+        self.llm_limiter = llm_limiter or RateLimiter() #shared by every game, cache hits skip it
+
+    def image_preset(self, name: str) -> ImagePreset:
+        try:
+            return self.image_presets[name]
+        except KeyError:
+            raise ValueError(f"Unknown image preset: {name}") from None
+
+    @staticmethod
+    def _sd_prompt(prompt: str) -> str:
+        return f"masterpiece,best quality,amazing quality, {prompt}"
+
+    def _sd_params(self, prompt: str, preset: str) -> txt2img_params:
+        p = self.image_preset(preset)
+        params = txt2img_params()
+        params.prompt = self._sd_prompt(prompt)
+        params.negative_prompt = "bad quality, worst quality, worst detail, censor, signature"
+        params.width = p.width
+        params.height = p.height
+        params.steps = p.steps
+        params.cfg_scale = p.cfg_scale
+        params.sampler_name = p.sampler_name
+        params.batch_size = 1
+        params.n_iter = 1
+        if self.stable_seeds:
+            params.seed = int(hashlib.sha256(params.prompt.encode("utf-8")).hexdigest()[:8], 16)
+        return params
+
+    async def open(self) -> None:
+        """Opens long-lived resources (connection pools etc). Called once on bot startup"""
+        pass
+
+    async def close(self) -> None:
+        """Releases resources opened in `open`. Called on bot shutdown"""
+        pass
     
-    async def generate_message(self, messages: List[Dict[str, str]]) -> str:
+    async def generate_message(self, messages: List[Dict[str, str]], cache: bool = True, priority: int = APIQueue.PRIORITY_NORMAL,
+                               batch: bool = False) -> str:
         """
         Generates an answer from the model based on messages.
         
         Args:
             messages: List of messages in the format [{"role": "...", "content": "..."}]
+            cache: Allow answer from llm_cache (and store the new one there)
+            priority: Priority in llm_limiter queue, see APIQueue.PRIORITY_*
+            batch: Request packs several items into JSON, only providers that handle it may serve it
             
         Returns:
             str: Model answer
         """
         raise NotImplementedError("Subclasses must implement generate_message")
 
-    async def generate_image(self, prompt: str) -> Image.Image:
+    async def stream_message(self, messages: List[Dict[str, str]], priority: int = APIQueue.PRIORITY_NORMAL) -> AsyncIterator[str]:
+        """
+        Generates an answer like generate_message, yielding text deltas as they arrive.
+        Clients without streaming yield the whole answer once.
+        """
+        yield await self.generate_message(messages, cache=False, priority=priority)
+
+    async def generate_image(self, prompt: str, uid: str = None, group: str = None, priority: int = APIQueue.PRIORITY_NORMAL,
+                             on_progress: ProgressCallback = None, preview: bool = False, preset: str = "landscape") -> EncodedImage:
         """
         Generates an image from the model based on prompt.
+
+        Args:
+            prompt: Image prompt
+            uid: Owner of the request for per-user queue limits (None - not limited)
+            group: Fair share group of the request (game, guild)
+            priority: Queue priority class, see APIQueue.PRIORITY_*
+            on_progress: Receives generation progress once the job is running
+            preview: Pass downscaled in-progress image to on_progress
+            preset: Name of the image preset (resolution, steps), see DEFAULT_IMAGE_PRESETS
         """
         raise NotImplementedError("Subclasses must implement generate_image")
 
+    async def generate_images(self, prompts: List[str], group: str = None, priority: int = APIQueue.PRIORITY_NORMAL,
+                              preset: str = "portrait") -> List[Optional[EncodedImage]]:
+        """
+        Generates one image per prompt. Backends that can batch do it in as few jobs as possible.
+        One failed image doesn't drop the others.
+
+        Returns:
+            List[Optional[EncodedImage]]: Images in the order of prompts, None where generation failed
+        """
+        return _partial_images(await asyncio.gather(*[
+            self.generate_image(prompt, group=group, priority=priority, preset=preset) for prompt in prompts
+        ], return_exceptions=True))
+
+    def stats(self) -> Dict[str, Any]:
+        """Runtime metrics of the client (cache hit rates, provider latencies...)"""
+        result = {}
+        if self.llm_cache is not None:
+            result["llm_cache"] = self.llm_cache.stats
+        result["llm_limiter"] = self.llm_limiter.stats()
+        return result
+
+    def cancel_images(self, uid: str = None, group: str = None) -> int:
+        """
+        Cancels queued and running image generations of the uid and/or group.
+
+        Returns:
+            int: Number of cancelled jobs
+        """
+        return 0
+
 
 
 class G4FClient(AIClient):
     """Client for working with g4f."""
     
-    def __init__(self, model: str, provider: Any, image_model: str, image_provider: Any, proxies: str = None):
-        super().__init__(model, provider, image_model, image_provider)
+    def __init__(self, model: str, provider: Any, image_model: str, image_provider: Any, proxies: str = None, sd_api: Union[WebUIApi, WebUIPool] = None, stable_seeds: bool = False,
+                 image_presets: Dict[str, ImagePreset] = None, max_batch: int = 8,
+                 sd_timeout: float = None, fallback_timeout: float = 120, hedge_after: float = None, sd_breaker: CircuitBreaker = None,
+                 llm_cache: LLMCache = None, batch_requests: Union[bool, List[str]] = False, router_options: Dict[str, Any] = None,
+                 llm_limiter: RateLimiter = None):
+        super().__init__(model, provider, image_model, image_provider, sd_api or WebUIApi(), image_presets, stable_seeds, llm_cache, llm_limiter)
+        # True - every provider handles batched JSON requests, or names of the providers that do
+        self.batch_providers = None if batch_requests is True else set(batch_requests or ())
+        # List of providers: every request goes to the fastest healthy one
+        self.router = ProviderRouter(list(provider), model, **(router_options or {})) if isinstance(provider, (list, tuple)) else None
         from g4f.client import AsyncClient
-        self.client = AsyncClient(provider=provider, proxies=proxies)
+        self.client = AsyncClient(provider=None if self.router else provider, proxies=proxies)
         self.image_client = AsyncClient(provider=image_provider)
+        self.image_queue = APIQueue(workers=self.sd_api.size, max_tasks=64)
+        self._queue_task: Optional[asyncio.Task] = None
+        # SD failures skip straight to the g4f image provider until a probe succeeds
+        self.sd_breaker = sd_breaker or CircuitBreaker("stable-diffusion")
+        self.sd_timeout = sd_timeout #deadline of one SD attempt including queue wait, None - no deadline
+        self.fallback_timeout = fallback_timeout
+        self.hedge_after = hedge_after #start fallback provider if SD is not done by then, None - no hedging
+        self.max_batch = max_batch #images in one packed SD job
+
+    async def open(self) -> None:
+        await self.sd_api.open()
+        self.sd_api.start_discovery()
+        if self._queue_task is None or self._queue_task.done():
+            self._queue_task = asyncio.create_task(self.image_queue.process_requests())
+
+    async def close(self) -> None:
+        if self._queue_task is not None:
+            self._queue_task.cancel()
+            self._queue_task = None
+        await self.sd_api.close()
+        if self.llm_cache is not None:
+            self.llm_cache.close()
     
-    async def generate_message(self, messages: List[Dict[str, str]]) -> str:
+    def cancel_images(self, uid: str = None, group: str = None) -> int:
+        cancelled = self.image_queue.cancel_where(uid, group)
+        if cancelled:
+            logger.info(f"Cancelled {cancelled} image jobs (uid: {uid}, group: {group})")
+        return cancelled
+    
+    def can_batch(self, provider: Any) -> bool:
+        return self.batch_providers is None or provider_name(provider) in self.batch_providers
+
+    @property
+    def batch_requests(self) -> bool:
+        providers = [v.provider for v in self.router.providers] if self.router is not None else [self.provider]
+        return any(self.can_batch(v) for v in providers)
+
+    async def generate_message(self, messages: List[Dict[str, str]], cache: bool = True, priority: int = APIQueue.PRIORITY_NORMAL,
+                               batch: bool = False) -> str:
+        key = None
+        if cache and self.llm_cache is not None:
+            key = self.llm_cache.make_key(messages, self.model, self.provider)
+            answer = await self.llm_cache.get(key)
+            if answer is not None:
+                return answer
+
+        if self.router is None:
+            if batch and not self.can_batch(self.provider):
+                raise ValueError(f"Provider {provider_name(self.provider)} doesn't handle batched requests")
+            async with self.llm_limiter.slot(self.provider, priority):
+                answer = await self.__complete(messages)
+        else:
+            # Slot is taken per provider before its latency and hedge deadline are measured
+            answer = await self.router.run(
+                lambda provider: self.__complete(messages, provider),
+                slot=lambda provider: self.llm_limiter.slot(provider, priority),
+                accept=self.can_batch if batch else None
+            )
+        if key is not None and answer:
+            await self.llm_cache.put(key, answer)
+        return answer
+
+    async def __complete(self, messages: List[Dict[str, str]], provider: Any = None) -> str:
+        kwargs = {"provider": provider} if provider is not None else {}
         response = await self.client.chat.completions.create(
             model=self.model,
-            messages=messages
+            messages=messages,
+            **kwargs
         )
-        return response.choices[0].message.content 
-    
-    # async def generate_image(self, prompt: str) -> Image.Image:
-    #     response = await self.image_client.images.generate(
-    #         model=self.image_model,
-    #         prompt=prompt,
-    #         response_format="b64_json"
-    #     )
-    #     # Convert base64 to PIL Image
-    #     image_bytes = base64.b64decode(response.data[0].b64_json)
-    #     image = Image.open(io.BytesIO(image_bytes))
-    #     return image
-
-    async def generate_image(self, prompt: str) -> Image.Image:
+        return response.choices[0].message.content
+
+    def stats(self) -> Dict[str, Any]:
+        result = super().stats()
+        if self.router is not None:
+            result["providers"] = self.router.stats()
+        return result
+
+    async def stream_message(self, messages: List[Dict[str, str]], priority: int = APIQueue.PRIORITY_NORMAL) -> AsyncIterator[str]:
+        if self.router is None:
+            async with self.llm_limiter.slot(self.provider, priority):
+                async for delta in self.__stream(messages):
+                    yield delta
+            return
+
+        # A started stream can't be hedged, only the provider choice is routed
+        async for delta in self.router.stream(
+            lambda provider: self.__stream(messages, provider),
+            slot=lambda provider: self.llm_limiter.slot(provider, priority)
+        ):
+            yield delta
+
+    async def __stream(self, messages: List[Dict[str, str]], provider: Any = None) -> AsyncIterator[str]:
+        kwargs = {"provider": provider} if provider is not None else {}
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            **kwargs
+        )
+        # Depending on g4f version create returns an async iterator or a coroutine resolving to one
+        if inspect.isawaitable(response):
+            response = await response
+
+        if not hasattr(response, "__aiter__"):
+            # Provider ignored stream=True and returned the whole completion
+            yield response.choices[0].message.content
+            return
 
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    async def _sd_submit(self, params: txt2img_params, uid: str, group: str, priority: int,
+                         on_progress: ProgressCallback = None, preview: bool = False) -> WebUIApiResult:
+        """SD WebUI attempt under the circuit breaker and `sd_timeout`. Raises CircuitOpen if SD is not called"""
+        if not self.sd_breaker.allow():
+            raise CircuitOpen(self.sd_breaker.name)
+        job = APIQueue.Params(
+            uid, lambda: self.sd_api.txt2img(params, on_progress, preview),
+            priority=priority, group=group
+        )
         try:
-            api = WebUIApi()
-            params = txt2img_params()
-            params.prompt = f"masterpiece,best quality,amazing quality, {prompt}"
-            params.negative_prompt = "bad quality, worst quality, worst detail, censor, signature"
-            params.width = 1216
-            params.height = 832
-            params.batch_size = 1
-            params.n_iter = 1
-            
-            result = await api.txt2img(params)
-            return result.image
-        except Exception as e:
-            logger.error(f"Error generating image: {e}")
-
-            response = await self.image_client.images.generate(
-                model=self.image_model,
-                prompt=prompt,
-                response_format="b64_json"
-            )
-            # Convert base64 to PIL Image
-            image_bytes = base64.b64decode(response.data[0].b64_json)
-            image = Image.open(io.BytesIO(image_bytes))
-            return image
-    
-    
+            result = await asyncio.wait_for(self.image_queue.submit(job), self.sd_timeout)
+        except (JobCancelled, MaxQueueReached, asyncio.CancelledError):
+            # Not the backend's fault
+            self.sd_breaker.release()
+            raise
+        except asyncio.TimeoutError:
+            if job.task is None:
+                # Timed out in our own queue, the backend is busy but not broken
+                self.sd_breaker.release()
+            else:
+                self.sd_breaker.failure()
+            raise
+        except Exception as E:
+            if _sd_backend_error(E):
+                self.sd_breaker.failure()
+            else:
+                self.sd_breaker.release()
+            raise
+        self.sd_breaker.success()
+        return result
+
+    async def _sd_image(self, prompt: str, uid: str, group: str, priority: int,
+                        on_progress: ProgressCallback, preview: bool, preset: str) -> EncodedImage:
+        result = await self._sd_submit(self._sd_params(prompt, preset), uid, group, priority, on_progress, preview)
+        return result.image
+
+    async def _sd_batch(self, prompts: List[str], group: str, priority: int, preset: str) -> List[EncodedImage]:
+        """Packs prompts into one SD job: plain batch for equal prompts, one prompt per line script otherwise"""
+        params = self._sd_params(prompts[0], preset)
+        if len(set(prompts)) == 1:
+            params.batch_size = len(prompts)
+        else:
+            # Every line is a separate prompt, so prompts must not contain line breaks
+            lines = [self._sd_prompt(" ".join(prompt.split())) for prompt in prompts]
+            params.script_name = "prompts from file or textbox"
+            params.script_args = [False, False, "start", "\n".join(lines)]
+
+        result = await self._sd_submit(params, None, group, priority)
+        # WebUI may put a grid in front of the batch
+        if len(result.images) < len(prompts):
+            raise ValueError(f"SD returned {len(result.images)} images for {len(prompts)} prompts")
+        return result.images[-len(prompts):]
+
+    async def generate_images(self, prompts: List[str], group: str = None, priority: int = APIQueue.PRIORITY_NORMAL,
+                              preset: str = "portrait") -> List[Optional[EncodedImage]]:
+        self.image_preset(preset)
+        chunks = [prompts[i:i + self.max_batch] for i in range(0, len(prompts), self.max_batch)]
+        results = await asyncio.gather(*[self.__generate_chunk(chunk, group, priority, preset) for chunk in chunks])
+        return [image for chunk in results for image in chunk]
+
+    async def __generate_chunk(self, prompts: List[str], group: str, priority: int, preset: str) -> List[Optional[EncodedImage]]:
+        if len(prompts) > 1:
+            try:
+                return await self._sd_batch(prompts, group, priority, preset)
+            except JobCancelled:
+                raise
+            except CircuitOpen:
+                pass
+            except Exception as e:
+                logger.error(f"Error generating image batch: {e!r}, generating one by one")
+        # One by one, with fallback provider and hedging of generate_image
+        return _partial_images(await asyncio.gather(*[
+            self.generate_image(prompt, group=group, priority=priority, preset=preset) for prompt in prompts
+        ], return_exceptions=True))
+
+    async def _fallback_image(self, prompt: str) -> EncodedImage:
+        response = await asyncio.wait_for(self.image_client.images.generate(
+            model=self.image_model,
+            prompt=prompt,
+            response_format="b64_json"
+        ), self.fallback_timeout)
+        # Keep encoded, decoding happens only if pixels are needed
+        return EncodedImage.from_base64(response.data[0].b64_json)
+
+    async def generate_image(self, prompt: str, uid: str = None, group: str = None, priority: int = APIQueue.PRIORITY_NORMAL,
+                             on_progress: ProgressCallback = None, preview: bool = False, preset: str = "landscape") -> EncodedImage:
+        self.image_preset(preset) #unknown preset is a caller bug, not a reason to fall back
+        primary = asyncio.create_task(self._sd_image(prompt, uid, group, priority, on_progress, preview, preset))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_after)
+            if not done:
+                return await self.__hedge(primary, prompt)
+            try:
+                return primary.result()
+            except CircuitOpen:
+                return await self._fallback_image(prompt)
+            except (JobCancelled, MaxQueueReached):
+                # Nobody needs the image anymore or the user is over the queue limit, no fallback
+                raise
+            except Exception as e:
+                if _sd_request_error(e):
+                    raise
+                logger.error(f"Error generating image: {e!r}")
+                return await self._fallback_image(prompt)
+        finally:
+            primary.cancel()
+
+    async def __hedge(self, primary: asyncio.Task, prompt: str) -> EncodedImage:
+        """SD is late: races it with the fallback provider, first image wins"""
+        logger.info(f"SD image is not ready in {self.hedge_after}s, starting fallback provider")
+        fallback = asyncio.create_task(self._fallback_image(prompt))
+        pending = {primary, fallback}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        return task.result()
+                    if isinstance(task.exception(), (JobCancelled, MaxQueueReached)) or _sd_request_error(task.exception()):
+                        raise task.exception()
+                    error = task.exception()
+                    logger.error(f"Error generating image: {error!r}")
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,50 @@
+import asyncio
+from typing import AsyncIterator, Iterable, TypeVar
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+async def merge_async_iterators(iterators: Iterable[AsyncIterator[T]], limit: int = None) -> AsyncIterator[T]:
+    """
+    Runs async iterators concurrently and yields their items in the order they are produced.
+
+    Args:
+        iterators: Async iterators (generators) to drain
+        limit: At most this many iterators run at the same time, None - no limit
+
+    The first exception of any iterator cancels the rest and is raised to the consumer.
+    Closing the merged iterator early cancels everything still running.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def drain(iterator: AsyncIterator[T]):
+        try:
+            if semaphore is None:
+                async for item in iterator:
+                    queue.put_nowait((item, None))
+            else:
+                async with semaphore:
+                    async for item in iterator:
+                        queue.put_nowait((item, None))
+        except Exception as E:
+            queue.put_nowait((None, E))
+        finally:
+            queue.put_nowait((_DONE, None))
+
+    tasks = [asyncio.create_task(drain(v)) for v in iterators]
+    running = len(tasks)
+    try:
+        while running:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                running -= 1
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
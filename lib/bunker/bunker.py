@@ -1,10 +1,13 @@
-from io import BytesIO
+import asyncio
 import random
 from typing import Optional
 import discord
 
 from lib.ai_client import G4FClient
 from lib.bunker.game_config import GameConfig
+from lib.bunker.discord_updates import image_file
+from lib.sd_api.sd_api import APIQueue
+from lib.async_utils import merge_async_iterators
 
 from textwrap import dedent
 
@@ -12,17 +15,39 @@ from textwrap import dedent
 class Bunker:
     """Класс, представляющий бункер в игре"""
     
-    def __init__(self, ai_client: G4FClient):
-        """Инициализация бункера"""
+    def __init__(self, ai_client: G4FClient, game_id: int = None, image_priority: int = APIQueue.PRIORITY_HIGH,
+                 llm_priority: int = APIQueue.PRIORITY_HIGH):
+        """
+        Инициализация бункера
+
+        Args:
+            ai_client: AI клиент для генерации
+            game_id: Идентификатор игры для честной очереди генерации изображений
+            image_priority: Приоритет изображения в очереди (заготовки для пула ждут живые игры)
+            llm_priority: Приоритет запросов катаклизма и описания бункера в очереди LLM
+        """
         self.ai_client = ai_client
+        self.game_id = game_id
+        self.image_priority = image_priority
+        self.llm_priority = llm_priority
+        self.theme = ""
+        self.disaster_info = ""
+        self.bunker_info = ""
+        self.image_prompt = ""
         self.size = ""
         self.duration = ""
         self.food = ""
         self.items = []
-        self.image = None  # Сохраняем PIL Image вместо URL
+        self.image = None  # EncodedImage, декодируется только при необходимости
     
     async def generate(self, theme: str = None):
-        """Генерация случайного бункера"""
+        """
+        Генерация случайного бункера.
+
+        Этапы идут графом: катаклизм и описание бункера генерируются одновременно,
+        промпт изображения ждёт только катаклизм, изображение - только промпт.
+        Статус отдаётся по мере завершения этапов.
+        """
         if theme:
             self.theme = theme
         else:
@@ -32,51 +57,84 @@ class Bunker:
         self.food = random.choice(GameConfig.FOOD_SUPPLIES)
         # Выбираем от 2 до 5 случайных предметов
         self.items = random.sample(GameConfig.BUNKER_ITEMS, k=random.randint(1, GameConfig.BUNKER_ITEMS_COUNT_MAX))
-        items_str = ", ".join(self.items)
 
         self.disaster_info = f"Тема: {self.theme}"
-        if GameConfig.GENERATE_DISASTER:  
-            yield "Генерирую катаклизм..."
-            self.disaster_info = await self.ai_client.generate_message([
-                {"role": "system", "content": "You are a helpful assistant that generates bunker disaster descriptions for a bunker game. Always respond in User language."},
-                {"role": "user", "content": dedent(f"""Сгенерируй случайный смертельный катаклизм для игры в\
-                    бункер на тему: {self.theme}. 
-                    Катаклизм - это то что происходит за пределами бункера! Не упоминай бункер в описании катаклизма.
-                    В зависимости от этого игроки будут выбирать кто заслуживает место в бункере. 
-                    В ответе оставь только само описание, не пиши ничего от своего имени. 
-                    В ответе укажи название катаклизма, его описание и с чём предстоит столкнуться вне бункера.
-                """)}])
-        
         self.bunker_info = ""
-        if GameConfig.GENERATE_BUNKER_DESC:
-            yield "Генерирую описание бункера..."
-            self.bunker_info = await self.ai_client.generate_message([
-                {"role": "system", "content": "You are description generator for a bunker game. Always respond in User language."},
-                {"role": "user", "content": dedent(f"""Сгенерируй краткое описание бункера по его характеристикам. Придумай какие комнаты в нём есть (в зависимости от размера и предметов в нём).
-                    В ответе оставь только само описание, не пиши ничего от своего имени. 
-                    Вот характеристики бункера: 
-                    Размер: {self.size}
-                    Еда: {self.food}
-                    Предметы: {items_str}
-                """)}])
-
-        # Генерация изображения бункера
-        if GameConfig.GENERATE_IMAGE:
-            yield "Генерирую изображение бункера..."
+        yield "Генерирую бункер..."
+
+        # Катаклизм нужен и себе, и промпту изображения
+        disaster = asyncio.ensure_future(self._generate_disaster())
+
+        async def disaster_stage():
+            if GameConfig.GENERATE_DISASTER:
+                await disaster
+                yield "Катаклизм готов"
+
+        async def bunker_info_stage():
+            if GameConfig.GENERATE_BUNKER_DESC:
+                await self._generate_bunker_info()
+                yield "Описание бункера готово"
+
+        async def image_stage():
+            if not GameConfig.GENERATE_IMAGE:
+                return
+            await disaster
             try:
-                self.image_prompt = await self.ai_client.generate_message([
-                {"role": "system", "content": "You are Stable Diffusion prompt generator. Always respond in English"},
-                {"role": "user", "content": dedent(f"""Generate a Stable Diffusion prompt for following disaster: {self.disaster_info}
-                    Describe the nature that is around the bunker, without mentioning the bunker in the prompt.
-                    Answer only with prompt, without any other text.
-                    Generate "tags" for the prompt, like "dark, atmospheric, disaster, etc."
-                    The image should be dark, atmospheric, and show the interior of the bunker with all the mentioned items visible.
-                """)}])
-
-                self.image = await self.ai_client.generate_image(self.image_prompt)
+                await self._generate_image_prompt()
+                yield "Промпт изображения готов"
+                await self._generate_image()
+                yield "Изображение бункера готово"
             except Exception as e:
                 print(f"Ошибка при генерации изображения бункера: {e}")
                 self.image = None
+
+        try:
+            async for status_msg in merge_async_iterators([disaster_stage(), bunker_info_stage(), image_stage()]):
+                yield status_msg
+        finally:
+            disaster.cancel()
+
+    async def _generate_disaster(self) -> None:
+        if not GameConfig.GENERATE_DISASTER:
+            return
+        self.disaster_info = await self.ai_client.generate_message([
+            {"role": "system", "content": "You are a helpful assistant that generates bunker disaster descriptions for a bunker game. Always respond in User language."},
+            {"role": "user", "content": dedent(f"""Сгенерируй случайный смертельный катаклизм для игры в\
+                бункер на тему: {self.theme}. 
+                Катаклизм - это то что происходит за пределами бункера! Не упоминай бункер в описании катаклизма.
+                В зависимости от этого игроки будут выбирать кто заслуживает место в бункере. 
+                В ответе оставь только само описание, не пиши ничего от своего имени. 
+                В ответе укажи название катаклизма, его описание и с чём предстоит столкнуться вне бункера.
+            """)}], priority=self.llm_priority)
+
+    async def _generate_bunker_info(self) -> None:
+        items_str = ", ".join(self.items)
+        self.bunker_info = await self.ai_client.generate_message([
+            {"role": "system", "content": "You are description generator for a bunker game. Always respond in User language."},
+            {"role": "user", "content": dedent(f"""Сгенерируй краткое описание бункера по его характеристикам. Придумай какие комнаты в нём есть (в зависимости от размера и предметов в нём).
+                В ответе оставь только само описание, не пиши ничего от своего имени. 
+                Вот характеристики бункера: 
+                Размер: {self.size}
+                Еда: {self.food}
+                Предметы: {items_str}
+            """)}], priority=self.llm_priority)
+
+    async def _generate_image_prompt(self) -> None:
+        self.image_prompt = await self.ai_client.generate_message([
+            {"role": "system", "content": "You are Stable Diffusion prompt generator. Always respond in English"},
+            {"role": "user", "content": dedent(f"""Generate a Stable Diffusion prompt for following disaster: {self.disaster_info}
+                Describe the nature that is around the bunker, without mentioning the bunker in the prompt.
+                Answer only with prompt, without any other text.
+                Generate "tags" for the prompt, like "dark, atmospheric, disaster, etc."
+                The image should be dark, atmospheric, and show the interior of the bunker with all the mentioned items visible.
+            """)}], priority=self.llm_priority)  # Старт игры ждёт изображение бункера, а значит и промпт
+
+    async def _generate_image(self) -> None:
+        # Изображение нужно для старта игры, поэтому идёт вперёд портретов
+        self.image = await self.ai_client.generate_image(
+            self.image_prompt, group=self.game_id, priority=self.image_priority,
+            preset=GameConfig.BUNKER_IMAGE_PRESET
+        )
         
     def get_description(self) -> str:
         """
@@ -100,17 +158,14 @@ class Bunker:
             "кто из выживших будет более полезен, учитывая данные обстоятельства."
         )
         
-    def get_image_file(self) -> Optional[discord.File]:
+    async def get_image_file(self) -> Optional[discord.File]:
         """
-        Конвертирует PIL Image в файл Discord для отправки
+        Конвертирует изображение в файл Discord для отправки
         
         Returns:
             Optional[discord.File]: Файл изображения или None, если изображение отсутствует
         """
         if self.image is None:
             return None
-            
-        image_bytes = BytesIO()
-        self.image.save(image_bytes, format='PNG')
-        image_bytes.seek(0)
-        return discord.File(image_bytes, filename='bunker.png')
\ No newline at end of file
+
+        return await image_file(self.image, 'bunker')
\ No newline at end of file
@@ -1,26 +1,33 @@
 from collections.abc import AsyncGenerator
+import asyncio
 import logging
 from typing import List, Dict, Optional
 
 from lib.ai_client import G4FClient
-from lib.bunker.player import Player
+from lib.bunker.player import Player, generate_descriptions
 from lib.bunker.bunker import Bunker
+from lib.bunker.bunker_pool import BunkerPool
 from lib.bunker.image_generator import ImageGenerator
+from lib.bunker.game_config import GameConfig
+from lib.sd_api.sd_api import APIQueue
+from lib.async_utils import merge_async_iterators
 
 class BunkerGame:
     """Base class for bunker game logic"""
     
-    def __init__(self, ai_client: G4FClient):
+    def __init__(self, ai_client: G4FClient, game_id: int = None):
         """
         Initialize the game
         
         Args:
             ai_client: AI client for generating content
+            game_id: Game identifier, used to share image generation queue fairly between games
         """
         self.ai_client = ai_client
+        self.game_id = game_id
         self.status = "waiting"  # waiting, running, finished
         self.players: List[Player] = []
-        self.bunker = Bunker(self.ai_client)
+        self.bunker = Bunker(self.ai_client, game_id)
         self.current_round = 0
         self.votes = {}  # {voter_id: voted_for_id}
         self.voted_players = set()  # Set of players who have voted
@@ -48,22 +55,95 @@ class BunkerGame:
         for player in self.players:
             if player.id == player_id:
                 player.is_active = False
+                # Portrait of the player who left is not needed anymore
+                self.ai_client.cancel_images(uid=player_id, group=self.game_id)
                 return True
         return False
     
-    async def generate_bunker(self, theme: str = None):
-        """Generate bunker"""
+    async def generate_bunker(self, theme: str = None, pool: BunkerPool = None):
+        """
+        Generate bunker
+
+        Args:
+            theme: Bunker theme, random if None
+            pool: Pool of pre-generated bunkers, the bunker is generated only if the pool has none
+        """
+        if pool is not None:
+            bunker = pool.take(theme, self.game_id)
+            if bunker is not None:
+                self.bunker = bunker
+                yield "Бункер уже готов"
+                return
+
         async for status_msg in self.bunker.generate(theme):
             logging.info(status_msg)
             yield status_msg
     
     async def generate_player_cards(self) -> AsyncGenerator[str, None]:
-        """Generate cards for all players"""
-        for player in self.players:
+        """Generate cards for all players concurrently, statuses come in completion order"""
+        if GameConfig.GENERATE_CHARACTER_DESC and GameConfig.BATCH_CHARACTER_DESC and self.ai_client.batch_requests:
+            async for status_msg in self.__generate_player_cards_batched():
+                yield status_msg
+            return
+
+        async def player_statuses(player: Player):
             async for status_msg in player.generate_character(self.ai_client):
                 logging.info(status_msg)
                 yield f"Игрок {player.name}: {status_msg}"
+
+        async for status_msg in merge_async_iterators(
+            [player_statuses(v) for v in self.players], GameConfig.CHARACTER_GENERATION_CONCURRENCY
+        ):
+            yield status_msg
     
+    async def __generate_player_cards_batched(self) -> AsyncGenerator[str, None]:
+        """Attributes locally, descriptions packed into few LLM requests, failed ones one by one"""
+        for player in self.players:
+            player.roll_attributes()
+        yield "Характеристики всех персонажей готовы"
+
+        yield "Генерация внешнего вида персонажей..."
+        size = max(1, GameConfig.CHARACTER_BATCH_SIZE)
+        chunks = [self.players[i:i + size] for i in range(0, len(self.players), size)]
+        failed = [v for chunk in await asyncio.gather(*[generate_descriptions(self.ai_client, c) for c in chunks]) for v in chunk]
+
+        if failed:
+            logging.warning(f"Batched descriptions failed for {len(failed)} players, generating one by one")
+
+            async def player_description(player: Player):
+                await player.generate_description(self.ai_client)
+                yield f"Игрок {player.name}: внешний вид готов"
+
+            async for status_msg in merge_async_iterators(
+                [player_description(v) for v in failed], GameConfig.CHARACTER_GENERATION_CONCURRENCY
+            ):
+                yield status_msg
+        yield "Внешний вид всех персонажей готов"
+
+    async def generate_portraits(self) -> List[Player]:
+        """
+        Generate portraits of all active players without one in a single batched image job
+
+        Returns:
+            List[Player]: Players that got a portrait
+        """
+        players = [v for v in self.get_active_players() if v.portrait is None]
+        if not players:
+            return []
+
+        prompts = await asyncio.gather(*[v.generate_portrait_prompt(self.ai_client) for v in players])
+        images = await self.ai_client.generate_images(
+            list(prompts), group=self.game_id, priority=APIQueue.PRIORITY_LOW, preset=GameConfig.CHARACTER_IMAGE_PRESET
+        )
+        done = []
+        for player, prompt, image in zip(players, prompts, images):
+            if image is None:
+                continue  # Ошибка уже в логе, остальные портреты сохраняем
+            player.portrait_prompt = prompt
+            player.portrait = image
+            done.append(player)
+        return done
+
     def generate_status_image(self) -> bytes:
         """
         Generate status table image
@@ -151,6 +231,10 @@ class BunkerGame:
             reason: Reason for game ending
         """
         self.status = "finished"
+
+        # Stop image generations nobody is going to see
+        if self.game_id is not None:
+            self.ai_client.cancel_images(group=self.game_id)
         
         # Reveal all attributes for all players
         for player in self.players:
@@ -158,32 +242,31 @@ class BunkerGame:
                             "hobby", "phobia", "inventory", "backpack", "additional"]:
                 player.reveal_attribute(attribute)
 
-    async def analyze_bunker_survival(self) -> str:
+    def survival_analysis_messages(self) -> Optional[List[Dict[str, str]]]:
         """
-        Analyze bunker survival chances with current players
-        
+        LLM messages for survival analysis of current players
+
         Returns:
-            str: Analysis text
+            Optional[List[Dict[str, str]]]: Messages or None if there are no active players
         """
-        try:
-            # Get active players
-            active_players = self.get_active_players()
-            if not active_players:
-                return "Некому выживать в бункере!"
-            
-            # Get bunker info
-            bunker_info = self.bunker.get_description()
-            
-            # Form player info
-            survivors_info = []
-            for i, player in enumerate(active_players, 1):
-                player_card = player.get_character_card()
-                survivors_info.append(f"**Игрок {i}: {player.name}**\n{player_card}")
-            
-            survivors_text = "\n\n".join(survivors_info)
-            
-            # Form prompt
-            prompt = f"""Проанализируй шансы на выживание группы людей в бункере при данных условиях.
+        # Get active players
+        active_players = self.get_active_players()
+        if not active_players:
+            return None
+        
+        # Get bunker info
+        bunker_info = self.bunker.get_description()
+        
+        # Form player info
+        survivors_info = []
+        for i, player in enumerate(active_players, 1):
+            player_card = player.get_character_card()
+            survivors_info.append(f"**Игрок {i}: {player.name}**\n{player_card}")
+        
+        survivors_text = "\n\n".join(survivors_info)
+        
+        # Form prompt
+        prompt = f"""Проанализируй шансы на выживание группы людей в бункере при данных условиях.
             
 ИНФОРМАЦИЯ О КАТАСТРОФЕ И БУНКЕРЕ:
 {bunker_info}
@@ -196,14 +279,35 @@ class BunkerGame:
 2. Сильные и слабые стороны группы и предметов
 3. Посчитай вероятность выживания группы в процентах
 """
+        return [
+            {"role": "system", "content": "Ты эксперт по выживанию. Анализируешь шансы выжить группе людей в бункере в условиях постапокалипсиса. Отвечай подробно, учитывай совместимость профессий, навыков и особенностей людей."},
+            {"role": "user", "content": prompt}
+        ]
+
+    async def analyze_bunker_survival(self) -> str:
+        """
+        Analyze bunker survival chances with current players
+        
+        Returns:
+            str: Analysis text
+        """
+        try:
+            messages = self.survival_analysis_messages()
+            if messages is None:
+                return "Некому выживать в бункере!"
             
             # Get AI analysis
-            survival_analysis = await self.ai_client.generate_message([
-                {"role": "system", "content": "Ты эксперт по выживанию. Анализируешь шансы выжить группе людей в бункере в условиях постапокалипсиса. Отвечай подробно, учитывай совместимость профессий, навыков и особенностей людей."},
-                {"role": "user", "content": prompt}
-            ])
-            
-            return survival_analysis
+            # Analysis is unique for every game and optional, gameplay requests go first
+            return await self.ai_client.generate_message(messages, cache=False, priority=APIQueue.PRIORITY_LOW)
         except Exception as e:
             logging.error(f"Error analyzing bunker survival: {e}")
-            return f"Произошла ошибка при анализе выживания: {e}" 
\ No newline at end of file
+            return f"Произошла ошибка при анализе выживания: {e}" 
+
+    async def stream_bunker_survival(self) -> AsyncGenerator[str, None]:
+        """Same as analyze_bunker_survival, yields analysis text as it is generated. Errors are raised"""
+        messages = self.survival_analysis_messages()
+        if messages is None:
+            yield "Некому выживать в бункере!"
+            return
+        async for delta in self.ai_client.stream_message(messages, priority=APIQueue.PRIORITY_LOW):
+            yield delta
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from lib.ai_client import G4FClient
+from lib.bunker.bunker import Bunker
+from lib.bunker.game_config import GameConfig
+from lib.sd_api.sd_api import APIQueue
+
+logger = logging.getLogger('bunker_game')
+
+
+class BunkerPool:
+    """
+    Пул заранее сгенерированных бункеров.
+
+    Фоновая задача держит по `theme_size` готовых бункеров на каждую тему из `themes`
+    и `random_size` бункеров со случайной темой. `take` отдаёт бункер сразу,
+    а пул пополняется в фоне. Бункеры старше `ttl` секунд выбрасываются,
+    суммарный размер (в основном изображения) ограничен `max_bytes`.
+    """
+
+    RANDOM = "*"  # Ключ пула бункеров со случайной темой
+
+    def __init__(self, ai_client: G4FClient, themes: List[str] = None, theme_size: int = 1, random_size: int = 2,
+                 ttl: float = 6 * 3600, max_bytes: int = 64 * 1024 * 1024, retry_delay: float = 60):
+        """
+        Args:
+            ai_client: AI клиент для генерации
+            themes: Темы, для которых держать готовые бункеры
+            theme_size: Сколько бункеров держать на каждую тему
+            random_size: Сколько бункеров держать со случайной темой
+            ttl: Время жизни готового бункера в секундах
+            max_bytes: Ограничение памяти пула
+            retry_delay: Пауза после неудачной генерации
+        """
+        self.ai_client = ai_client
+        self.targets: Dict[str, int] = {self.RANDOM: random_size, **{theme: theme_size for theme in themes or []}}
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.retry_delay = retry_delay
+
+        self.pools: Dict[str, deque] = {key: deque() for key in self.targets}  # ключ: [(время создания, бункер)]
+        self.hits = 0
+        self.misses = 0
+        self._wanted = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @staticmethod
+    def bunker_size(bunker: Bunker) -> int:
+        size = len(bunker.disaster_info) + len(bunker.bunker_info) + len(bunker.image_prompt)
+        if bunker.image is not None:
+            size += len(bunker.image.data)
+        return size
+
+    @property
+    def size(self) -> int:
+        return sum(len(v) for v in self.pools.values())
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.bunker_size(bunker) for pool in self.pools.values() for _, bunker in pool)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self.__produce())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Останавливает фоновую генерацию, ждёт её завершения не дольше `timeout` секунд"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._task.cancel()
+        # asyncio.wait не пробрасывает отмену задачи, но пробрасывает отмену самого stop()
+        done, _ = await asyncio.wait([self._task], timeout=timeout)
+        if not done:
+            logger.warning(f"Пул бункеров не остановился за {timeout} с")
+        self._task = None
+
+    def take(self, theme: str = None, game_id: int = None) -> Optional[Bunker]:
+        """
+        Забирает готовый бункер. Без темы подходит бункер любой темы.
+
+        Returns:
+            Optional[Bunker]: Бункер или None, если подходящего нет (тогда его нужно сгенерировать)
+        """
+        self.__expire()
+        if theme:
+            keys = [theme] if self.pools.get(theme) else []
+        else:
+            keys = [self.RANDOM] if self.pools[self.RANDOM] else [k for k, v in self.pools.items() if v]
+
+        if not keys:
+            self.misses += 1
+            return None
+
+        _, bunker = self.pools[random.choice(keys)].popleft()
+        bunker.game_id = game_id
+        bunker.image_priority = APIQueue.PRIORITY_HIGH
+        bunker.llm_priority = APIQueue.PRIORITY_HIGH
+        self.hits += 1
+        self._wanted.set()
+        return bunker
+
+    def __expire(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        for pool in self.pools.values():
+            while pool and pool[0][0] < deadline:
+                pool.popleft()
+
+    def __deficit(self) -> Optional[str]:
+        """Ключ пула, которому не хватает бункеров (случайная тема первой)"""
+        for key, target in self.targets.items():
+            if len(self.pools[key]) < target:
+                return key
+        return None
+
+    def __add(self, key: str, bunker: Bunker) -> None:
+        self.pools[key].append((time.monotonic(), bunker))
+        # Вытесняем самые старые бункеры, пока не уложимся в лимит памяти
+        while self.total_bytes > self.max_bytes:
+            oldest = min((v for v in self.pools.values() if v), key=lambda v: v[0][0])
+            oldest.popleft()
+
+    async def __generate(self, key: str) -> Bunker:
+        # Заготовки делят очередь изображений честно между собой и не обгоняют живые игры
+        bunker = Bunker(self.ai_client, game_id="bunker_pool", image_priority=APIQueue.PRIORITY_LOW,
+                        llm_priority=APIQueue.PRIORITY_LOW)
+        async for _ in bunker.generate(None if key == self.RANDOM else key):
+            pass
+        return bunker
+
+    async def __produce(self) -> None:
+        while not self._stopping:
+            self.__expire()
+            key = self.__deficit()
+            if key is None:
+                self._wanted.clear()
+                # Проверяем и по таймеру, чтобы заменять устаревшие бункеры.
+                # Не wait_for: он может потерять отмену, пришедшую вместе с событием
+                waiter = asyncio.create_task(self._wanted.wait())
+                try:
+                    await asyncio.wait([waiter], timeout=min(self.ttl, 300))
+                finally:
+                    waiter.cancel()
+                continue
+
+            try:
+                bunker = await self.__generate(key)
+            except Exception as e:
+                logger.error(f"Ошибка генерации бункера для пула ({key}): {e}", exc_info=True)
+                await asyncio.sleep(self.retry_delay)
+                continue
+
+            if GameConfig.GENERATE_IMAGE and bunker.image is None:
+                # Без изображения бункер хуже сгенерированного на месте, пробуем позже
+                logger.warning(f"Бункер для пула ({key}) без изображения, повтор через {self.retry_delay} с")
+                await asyncio.sleep(self.retry_delay)
+                continue
+
+            self.__add(key, bunker)
+            logger.info(f"Бункер добавлен в пул ({key}), готово: {self.size}")
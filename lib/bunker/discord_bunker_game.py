@@ -6,9 +6,12 @@ from typing import Optional, Dict
 from lib.bunker.bunker_game import BunkerGame
 from lib.bunker.game_config import GameConfig
 from lib.bunker.player import Player
+from lib.bunker.discord_updates import EmbedStreamWriter
 
 class DiscordBunkerGame(BunkerGame):
     """Discord-specific implementation of BunkerGame"""
+
+    MAX_EMBED_LENGTH = 1000  # Analysis text per embed
     
     def __init__(self, ai_client, admin_id: int, channel_id: int):
         """
@@ -19,7 +22,7 @@ class DiscordBunkerGame(BunkerGame):
             admin_id: ID of game admin
             channel_id: ID of Discord channel where game is played
         """
-        super().__init__(ai_client)
+        super().__init__(ai_client, channel_id)
         self.admin_id = admin_id
         self.channel_id = channel_id
         self.message_id = None
@@ -126,17 +129,29 @@ class DiscordBunkerGame(BunkerGame):
             # Send analyzing message
             analyzing_message = await channel.send("🔍 Анализирую шансы выживания обитателей бункера...")
             
-            # Get analysis from parent class
-            analysis_text = await self.analyze_bunker_survival()
-            
-            # Delete analyzing message
+            # Stream analysis into embeds, the placeholder becomes the first one
+            writer = EmbedStreamWriter(
+                channel, "🔍 Анализ выживания в бункере", discord.Color.blue(),
+                max_length=self.MAX_EMBED_LENGTH, placeholder=analyzing_message
+            )
             try:
-                await analyzing_message.delete()
-            except:
-                pass
-            
-            # Send results
-            await self._send_analysis_results(channel, analysis_text)
+                async for delta in self.stream_bunker_survival():
+                    await writer.write(delta)
+            except Exception as e:
+                if writer.started:
+                    raise
+                logging.getLogger('bunker_game').warning(f"Streaming analysis failed, falling back: {e}")
+            finally:
+                await writer.close()
+
+            if not writer.started:
+                # Nothing shown: get the whole answer at once
+                analysis_text = await self.analyze_bunker_survival()
+                try:
+                    await analyzing_message.delete()
+                except:
+                    pass
+                await self._send_analysis_results(channel, analysis_text)
         except Exception as e:
             logger = logging.getLogger('bunker_game')
             logger.error(f"Error analyzing bunker survival: {e}")
@@ -153,7 +168,7 @@ class DiscordBunkerGame(BunkerGame):
             channel: Discord channel to send to
             analysis_text: Analysis text from AI
         """
-        MAX_EMBED_LENGTH = 1000
+        MAX_EMBED_LENGTH = self.MAX_EMBED_LENGTH
         title = "🔍 Анализ выживания в бункере"
         
         if len(analysis_text) <= MAX_EMBED_LENGTH:
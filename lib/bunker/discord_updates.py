@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from io import BytesIO
+from typing import List, Optional
+
+import discord
+
+from lib.bunker.game_config import GameConfig
+from lib.sd_api.shared import EncodedImage, EncodeOptions, DetectFormat, FormatExtension
+
+logger = logging.getLogger('bunker_game')
+
+
+class ThrottledMessageEditor:
+    """
+    Редактирует сообщение Discord не чаще чем раз в `min_interval` секунд.
+    Промежуточные состояния отбрасываются, отправляется только последнее.
+    """
+
+    def __init__(self, message: discord.Message, min_interval: float = 1.5):
+        """
+        Args:
+            message: Сообщение для редактирования
+            min_interval: Минимальный интервал между правками (лимиты Discord ~5 правок за 5 секунд)
+        """
+        self.message = message
+        self.min_interval = min_interval
+        self._pending: Optional[dict] = None
+        self._last_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, **kwargs) -> None:
+        """Запланировать правку сообщения (аргументы как у Message.edit)"""
+        self._pending = kwargs
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__flush())
+
+    async def __flush(self) -> None:
+        while self._pending is not None:
+            delay = self._last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            kwargs, self._pending = self._pending, None
+            self._last_edit = time.monotonic()
+            try:
+                await self.message.edit(**kwargs)
+            except discord.HTTPException as e:
+                logger.warning(f"Ошибка обновления сообщения: {e}")
+
+    async def flush(self) -> None:
+        """Дождаться отправки последнего состояния"""
+        if self._task is not None:
+            await self._task
+
+    def cancel(self) -> None:
+        """Отменить неотправленные правки"""
+        self._pending = None
+        if self._task is not None:
+            self._task.cancel()
+
+
+def split_point(text: str, limit: int) -> int:
+    """Где разрезать текст не длиннее `limit`: конец предложения, иначе пробел, иначе жёстко"""
+    if len(text) <= limit:
+        return len(text)
+    head = text[:limit]
+    for separators in (("\n",), (". ", "! ", "? "), (" ",)):
+        cut = max(head.rfind(v) for v in separators)
+        if cut > limit // 2:
+            return cut + 1
+    return limit
+
+
+class EmbedStreamWriter:
+    """
+    Выводит поток текста (например, ответ LLM по частям) в эмбеды канала.
+    Эмбед правится с ограничением частоты, при превышении `max_length`
+    текст продолжается в новом эмбеде.
+    """
+
+    CURSOR = " ▌"
+
+    def __init__(self, channel: discord.abc.Messageable, title: str, color: discord.Color,
+                 max_length: int = 1000, placeholder: Optional[discord.Message] = None, min_interval: float = 1.5):
+        """
+        Args:
+            channel: Канал для отправки
+            title: Заголовок эмбедов
+            color: Цвет эмбедов
+            max_length: Максимальная длина текста одного эмбеда
+            placeholder: Сообщение-заглушка, которое станет первым эмбедом
+            min_interval: Минимальный интервал между правками одного сообщения
+        """
+        self.channel = channel
+        self.title = title
+        self.color = color
+        self.max_length = max_length
+        self.min_interval = min_interval
+
+        self.parts: List[str] = []  # Завершённые части
+        self.messages: List[discord.Message] = []
+        self._text = ""  # Текущая часть
+        self._placeholder = placeholder
+        self._editor: Optional[ThrottledMessageEditor] = None
+
+    @property
+    def started(self) -> bool:
+        return bool(self.messages)
+
+    def _embed(self, text: str, index: int, total: Optional[int] = None) -> discord.Embed:
+        title = self.title
+        if total is not None and total > 1:
+            title = f"{self.title} (Часть {index + 1}/{total})"
+        elif total is None and index > 0:
+            title = f"{self.title} (Часть {index + 1})"
+        return discord.Embed(title=title, description=text, color=self.color)
+
+    async def __show(self, text: str) -> None:
+        """Показать текущую часть: первое появление отправкой, дальше через троттлинг"""
+        index = len(self.parts)
+        embed = self._embed(text, index)
+        if len(self.messages) > index:
+            self._editor.update(embed=embed)
+            return
+
+        if self._placeholder is not None:
+            message, self._placeholder = self._placeholder, None
+            await message.edit(content=None, embed=embed)
+        else:
+            message = await self.channel.send(embed=embed)
+        self.messages.append(message)
+        self._editor = ThrottledMessageEditor(message, self.min_interval)
+
+    async def write(self, delta: str) -> None:
+        self._text += delta
+        # Переполненная часть завершается, остаток уходит в следующий эмбед
+        while len(self._text) > self.max_length:
+            cut = split_point(self._text, self.max_length)
+            part, self._text = self._text[:cut].strip(), self._text[cut:].lstrip()
+            await self.__show(part)
+            await self._editor.flush()
+            self.parts.append(part)
+        if self._text.strip():
+            await self.__show(self._text + self.CURSOR)
+
+    async def close(self) -> None:
+        """Финальный текст без курсора, нумерация частей из общего количества"""
+        if self._text.strip():
+            await self.__show(self._text.strip())
+            self.parts.append(self._text.strip())
+            self._text = ""
+        if self._editor is not None:
+            await self._editor.flush()
+
+        if len(self.parts) > 1:
+            for i, (message, part) in enumerate(zip(self.messages, self.parts)):
+                try:
+                    await message.edit(embed=self._embed(part, i, len(self.parts)))
+                except discord.HTTPException as e:
+                    logger.warning(f"Ошибка обновления сообщения: {e}")
+
+
+def upload_options() -> EncodeOptions:
+    """Настройки кодирования изображений для загрузки в Discord из GameConfig"""
+    return EncodeOptions(
+        format=GameConfig.IMAGE_UPLOAD_FORMAT,
+        quality=GameConfig.IMAGE_UPLOAD_QUALITY,
+        max_bytes=GameConfig.IMAGE_UPLOAD_MAX_BYTES,
+    )
+
+
+async def image_file(image: EncodedImage, name: str) -> discord.File:
+    """
+    Кодирует изображение для Discord в отдельном потоке (результат кэшируется в изображении)
+
+    Args:
+        image: Изображение
+        name: Имя файла без расширения
+    """
+    data = await image.encode(upload_options())
+    return discord.File(BytesIO(data), filename=f"{name}.{FormatExtension(DetectFormat(data))}")
@@ -5,7 +5,28 @@ class GameConfig:
     GENERATE_DISASTER       = True
     GENERATE_BUNKER_DESC    = True
     GENERATE_CHARACTER_DESC = True
+    BATCH_CHARACTER_DESC    = True  # Внешность всех персонажей одним запросом, если есть провайдер, который это поддерживает (batch_requests)
     GENERATE_ANALYSIS       = True
+    IMAGE_PROGRESS_PREVIEW  = True  # Показывать превью во время генерации изображения
+    CHARACTER_GENERATION_CONCURRENCY = 5  # Сколько персонажей генерируется одновременно
+    CHARACTER_BATCH_SIZE    = 8  # Персонажей в одном пакетном запросе
+
+    # Пресеты изображений (разрешение, шаги), см. DEFAULT_IMAGE_PRESETS в ai_client
+    BUNKER_IMAGE_PRESET     = "landscape"
+    CHARACTER_IMAGE_PRESET  = "portrait"
+
+    # Кодирование изображений перед отправкой в Discord
+    IMAGE_UPLOAD_FORMAT     = "WEBP"  # PNG, JPEG или WEBP
+    IMAGE_UPLOAD_QUALITY    = 85
+    IMAGE_UPLOAD_MAX_BYTES  = 1024 * 1024  # Уменьшать изображение до этого размера, 0 - не ограничивать
+
+    # Пул заранее сгенерированных бункеров
+    BUNKER_POOL_ENABLED     = True
+    BUNKER_POOL_THEMES      = []  # Темы с отдельным запасом бункеров, например "Зомби апокалипсис"
+    BUNKER_POOL_THEME_SIZE  = 1  # Бункеров на каждую тему из BUNKER_POOL_THEMES
+    BUNKER_POOL_RANDOM_SIZE = 2  # Бункеров со случайной темой
+    BUNKER_POOL_TTL         = 6 * 3600  # Секунды, после которых бункер заменяется новым
+    BUNKER_POOL_MAX_MB      = 64
     
     # Data for generating player cards
     GENDERS = [
@@ -1,13 +1,21 @@
 
 
+import json
+import logging
 import random
-from typing import Any, List, Optional, Tuple, AsyncGenerator
+from typing import Any, Dict, List, Optional, Tuple, AsyncGenerator
 from textwrap import dedent
 
 import numpy as np
 
 from lib.ai_client import G4FClient
 from lib.bunker.game_config import GameConfig
+from lib.sd_api.sd_api import APIQueue
+
+logger = logging.getLogger('bunker_game')
+
+DESCRIPTION_SYSTEM_PROMPT = "You are a helpful assistant that generates character descriptions for a bunker game. Always respond in User language."
+DESCRIPTION_FIELDS = "Имя, цвет глаз, цвет волос, стиль причёски, цвет кожи, стиль одежды, цвета одежды"
 
 def weighed_random(tbl: List[Tuple[Any, float]]) -> Any:
     items = [x[0] for x in tbl]  # Элементы
@@ -59,12 +67,25 @@ class Player:
         
         # Активен ли игрок (не выбыл из игры)
         self.is_active = True
+
+        # Сгенерированный портрет персонажа (EncodedImage) и его промпт
+        self.portrait = None
+        self.portrait_prompt = ""
     
     async def generate_character(self, ai_client: G4FClient) -> AsyncGenerator[str, None]:
         """Генерация случайных характеристик персонажа"""
 
-        # Генерация пола
         yield "Генерация основной информации..."
+        self.roll_attributes()
+
+        if GameConfig.GENERATE_CHARACTER_DESC:
+            yield "Генерация внешнего вида персонажа..."
+            await self.generate_description(ai_client)
+
+    def roll_attributes(self) -> None:
+        """Случайные характеристики персонажа без обращения к LLM"""
+
+        # Генерация пола
         gender = weighed_random(GameConfig.GENDERS)
         gender_affix = weighed_random(GameConfig.GENDER_AFFIXES)
         years_old = weighed_random(GameConfig.AGES)
@@ -136,16 +157,27 @@ class Player:
         self.additional = random.choice(GameConfig.ADDITIONAL_INFO)
 
         self.description = ""
-        if GameConfig.GENERATE_CHARACTER_DESC:
-            yield "Генерация внешнего вида персонажа..."
-            self.description = await ai_client.generate_message([
-                {"role": "system", "content": "You are a helpful assistant that generates character descriptions for a bunker game. Always respond in User language."},
-                {"role": "user", "content": dedent(f"""Сгенерируй краткое внешнее описание для персонажа. 
-                    В ответе оставь только само описание, не пиши ничего от своего имени.
-                    Придумай для персонажа: Имя, цвет глаз, цвет волос, стиль причёски, цвет кожи, стиль одежды, цвета одежды
-                    Вот досье персонажа, которого нужно сгенерировать (исходя из него, придумывай): {self.get_character_card()}
-                """)}])
+
+    async def generate_description(self, ai_client: G4FClient) -> None:
+        """Генерация внешнего вида персонажа отдельным запросом"""
+        self.description = await ai_client.generate_message([
+            {"role": "system", "content": DESCRIPTION_SYSTEM_PROMPT},
+            {"role": "user", "content": dedent(f"""Сгенерируй краткое внешнее описание для персонажа. 
+                В ответе оставь только само описание, не пиши ничего от своего имени.
+                Придумай для персонажа: {DESCRIPTION_FIELDS}
+                Вот досье персонажа, которого нужно сгенерировать (исходя из него, придумывай): {self.get_character_card()}
+            """)}])
                 
+    async def generate_portrait_prompt(self, ai_client: G4FClient) -> str:
+        """Генерация промпта Stable Diffusion для портрета персонажа"""
+        return await ai_client.generate_message([
+            {"role": "system", "content": "You are Stable Diffusion prompt generator. Always respond in English"},
+            {"role": "user", "content": f"""Generate a Stable Diffusion prompt for following person: {self.get_character_card()}
+Answer only with prompt, without any other text.
+Describe person with "tags" like "A woman 38 years old, blonde hair, blue eyes, etc.",
+Describe old or young, male or female, etc.
+"""}], priority=APIQueue.PRIORITY_LOW)
+
     def get_formatted_attribute(self, attribute: str) -> str:
         """
         Получение форматированной характеристики персонажа
@@ -208,4 +240,70 @@ class Player:
         """
         if self.revealed_attributes.get(attribute, False):
             return getattr(self, attribute, "err") #attribute_map.get(attribute)
-        return None
\ No newline at end of file
+        return None
+
+
+def parse_descriptions(answer: str, count: int) -> Dict[int, str]:
+    """
+    Разбирает ответ пакетного запроса: JSON массив [{"id": номер, "description": "..."}].
+    Неверные элементы пропускаются.
+
+    Returns:
+        Dict[int, str]: Номер персонажа: описание
+    """
+    # Модель может окружить массив текстом со своими скобками: пробуем разобрать массив с каждой "["
+    decoder = json.JSONDecoder()
+    best: Dict[int, str] = {}
+    pos = answer.find("[")
+    while pos >= 0:
+        try:
+            items, end = decoder.raw_decode(answer, pos)
+        except ValueError:
+            items, end = None, pos + 1
+        if isinstance(items, list):
+            result = _collect_descriptions(items, count)
+            if len(result) > len(best):
+                best = result
+        pos = answer.find("[", end)
+    return best
+
+
+def _collect_descriptions(items: list, count: int) -> Dict[int, str]:
+    result = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index, description = item.get("id"), item.get("description")
+        if isinstance(index, int) and 0 <= index < count and isinstance(description, str) and description.strip():
+            result.setdefault(index, description.strip())
+    return result
+
+
+async def generate_descriptions(ai_client: G4FClient, players: List[Player]) -> List[Player]:
+    """
+    Генерация внешности нескольких персонажей одним запросом (JSON массив на входе и на выходе)
+
+    Returns:
+        List[Player]: Персонажи, для которых ответ не удалось разобрать
+    """
+    cards = [{"id": i, "card": player.get_character_card()} for i, player in enumerate(players)]
+    try:
+        answer = await ai_client.generate_message([
+            {"role": "system", "content": DESCRIPTION_SYSTEM_PROMPT},
+            {"role": "user", "content": dedent(f"""Сгенерируй краткое внешнее описание для каждого персонажа из списка.
+                Для каждого придумай: {DESCRIPTION_FIELDS}. Исходи из досье персонажа.
+                Ответь только JSON массивом вида [{{"id": id персонажа, "description": "описание"}}], без другого текста.
+                Персонажи (JSON): {json.dumps(cards, ensure_ascii=False)}
+            """)}], batch=True)
+        descriptions = parse_descriptions(answer, len(players))
+    except Exception as e:
+        logger.error(f"Ошибка пакетной генерации внешности: {e}")
+        descriptions = {}
+
+    failed = []
+    for i, player in enumerate(players):
+        if i in descriptions:
+            player.description = descriptions[i]
+        else:
+            failed.append(player)
+    return failed
@@ -0,0 +1,73 @@
+import time
+import logging
+
+logger = logging.getLogger("ai_client")
+
+
+class CircuitOpen(Exception):
+    """Call rejected by an open circuit breaker"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend that keeps failing.
+
+    closed - calls go through, consecutive failures are counted.
+    open - calls are rejected until `reset_timeout` passes.
+    half_open - up to `half_open_probes` calls are let through as probes,
+    a successful probe closes the breaker, a failed one opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30, half_open_probes: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0 #probes in flight while half open
+        self._state = self.CLOSED
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self.probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go to the backend now. Counts the call as a probe when half open"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return True
+        return False
+
+    def release(self):
+        """Call was allowed but ended without a verdict (cancelled), frees the probe slot"""
+        if self._state == self.HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"Circuit {self.name} closed")
+        self._state = self.CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def failure(self):
+        self.failures += 1
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(f"Circuit {self.name} opened for {self.reset_timeout}s after {self.failures} failures")
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probes = 0
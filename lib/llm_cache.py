@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("ai_client")
+
+
+def provider_name(provider: Any) -> str:
+    """Stable name of a g4f provider, provider class or RetryProvider"""
+    if provider is None:
+        return ""
+    if isinstance(provider, str):
+        return provider
+    if isinstance(provider, (list, tuple)):
+        return "+".join(provider_name(v) for v in provider)
+    providers = getattr(provider, "providers", None)
+    if providers:
+        return "+".join(provider_name(v) for v in providers)
+    return getattr(provider, "__name__", None) or type(provider).__name__
+
+
+class LLMCache:
+    """
+    Cache of LLM answers keyed on normalized messages, model and provider.
+
+    Keeps up to `variety` answers per key: while there are fewer, a lookup is a miss
+    and the new answer is added, after that a random one of them is returned.
+    Answers older than `ttl` seconds are dropped. With `path` answers are also
+    stored in SQLite and survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 7 * 24 * 3600, variety: int = 3, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variety = max(1, variety)
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: OrderedDict[str, List[tuple[float, str]]] = OrderedDict() #key: [(created, answer)]
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT NOT NULL, created REAL NOT NULL, answer TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS answers_key ON answers (key)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(messages: List[Dict[str, str]], model: str = None, provider: Any = None) -> str:
+        normalized = [
+            {"role": str(v.get("role", "")).strip().lower(), "content": " ".join(str(v.get("content", "")).split())}
+            for v in messages
+        ]
+        data = json.dumps([normalized, model or "", provider_name(provider)], ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "keys": len(self._memory),
+        }
+
+    def __fresh(self, variants: List[tuple[float, str]]) -> List[tuple[float, str]]:
+        deadline = time.time() - self.ttl
+        return [v for v in variants if v[0] > deadline]
+
+    def __load(self, key: str) -> List[tuple[float, str]]:
+        if self._db is None:
+            return []
+        rows = self._db.execute("SELECT created, answer FROM answers WHERE key = ? ORDER BY created", (key,)).fetchall()
+        return [(created, answer) for created, answer in rows]
+
+    def get_sync(self, key: str) -> Optional[str]:
+        with self._lock:
+            variants = self._memory.get(key)
+            if variants is None:
+                variants = self.__load(key)
+            variants = self.__fresh(variants)
+            if variants:
+                self._memory[key] = variants
+                self._memory.move_to_end(key)
+                self.__evict()
+            else:
+                self._memory.pop(key, None)
+
+            if len(variants) < self.variety:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return random.choice(variants)[1]
+
+    def put_sync(self, key: str, answer: str):
+        created = time.time()
+        with self._lock:
+            variants = self.__fresh(self._memory.get(key) or self.__load(key))
+            variants.append((created, answer))
+            dropped = variants[:-self.variety]
+            self._memory[key] = variants[-self.variety:]
+            self._memory.move_to_end(key)
+            self.__evict()
+
+            if self._db is not None:
+                self._db.execute("INSERT INTO answers (key, created, answer) VALUES (?, ?, ?)", (key, created, answer))
+                if dropped:
+                    self._db.execute("DELETE FROM answers WHERE key = ? AND created <= ?", (key, dropped[-1][0]))
+                self._db.commit()
+
+    def __evict(self):
+        #only memory is bounded, SQLite keeps evicted keys
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def purge_sync(self) -> int:
+        """Removes expired answers from SQLite. Returns number of removed rows"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM answers WHERE created <= ?", (time.time() - self.ttl,))
+            self._db.commit()
+            return cursor.rowcount
+
+    async def get(self, key: str) -> Optional[str]:
+        if self._db is None:
+            return self.get_sync(key)
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key: str, answer: str):
+        if self._db is None:
+            return self.put_sync(key, answer)
+        await asyncio.to_thread(self.put_sync, key, answer)
+
+    def close(self):
+        #a get/put may still run in a worker thread
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from lib.circuit_breaker import CircuitBreaker
+from lib.llm_cache import provider_name
+
+logger = logging.getLogger("ai_client")
+
+T = TypeVar("T")
+
+
+class ProviderStats:
+    """Rolling latency and error window of one provider/model"""
+
+    def __init__(self, provider: Any, model: str = None, window: int = 50, breaker: CircuitBreaker = None):
+        self.provider = provider
+        self.name = f"{provider_name(provider)}/{model}" if model else provider_name(provider)
+        self.latencies: deque = deque(maxlen=window) #successful calls only
+        self.results: deque = deque(maxlen=window) #True - success
+        self.recent: Optional[float] = None #moving average of latency, follows changes faster than the median
+        self.in_flight = 0
+        self.breaker = breaker or CircuitBreaker(self.name)
+
+    def record(self, latency: float, ok: bool):
+        self.results.append(ok)
+        if ok:
+            self.__add_latency(latency)
+            self.breaker.success()
+        else:
+            self.breaker.failure()
+
+    def record_cancelled(self, latency: float):
+        """Call lost the hedge or was cancelled: elapsed time is a lower bound of its latency"""
+        #a short cancelled call says nothing, a long one shows the provider got slower
+        if self.recent is None or latency > self.recent:
+            self.__add_latency(latency)
+        self.breaker.release()
+
+    def __add_latency(self, latency: float):
+        self.latencies.append(latency)
+        self.recent = latency if self.recent is None else self.recent + 0.3 * (latency - self.recent)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.results.count(False) / len(self.results) if self.results else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def score(self) -> float:
+        """Expected time to a good answer, lower is better. Unknown provider looks fast, so it gets tried"""
+        median = self.percentile(50)
+        if median is None:
+            return 0.0
+        #a provider that just got slower is demoted before its median catches up
+        median = max(median, self.recent)
+        #a failed call costs a retry elsewhere, roughly one more median
+        return median * (1 + self.error_rate) + self.in_flight * 0.1 * median
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": len(self.results),
+            "error_rate": self.error_rate,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "recent": self.recent,
+            "in_flight": self.in_flight,
+            "state": self.breaker.state,
+        }
+
+
+class ProviderRouter:
+    """
+    Sends each request to the provider with the best recent latency and error rate.
+
+    A request that runs longer than `hedge_percentile` of its provider's latency
+    is duplicated to the next best provider, the first answer wins.
+    Failed requests go to the next provider until every one was tried.
+    `explore` is the share of requests sent to a random healthy provider to keep its stats fresh.
+    """
+
+    def __init__(self, providers: List[Any], model: str = None, window: int = 50, hedge_percentile: float = 95,
+                 hedge_min: float = 2.0, hedge_max: float = 60.0, min_samples: int = 5, explore: float = 0.05,
+                 failure_threshold: int = 3, reset_timeout: float = 60):
+        if not providers:
+            raise ValueError("ProviderRouter needs at least one provider")
+        self.providers = [
+            ProviderStats(v, model, window, CircuitBreaker(provider_name(v), failure_threshold, reset_timeout)) for v in providers
+        ]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min = hedge_min
+        self.hedge_max = hedge_max
+        self.min_samples = min_samples
+        self.explore = explore
+
+    def ranked(self) -> List[ProviderStats]:
+        """Healthy providers fastest first, then the ones with open circuit"""
+        healthy = sorted((v for v in self.providers if v.healthy), key=lambda v: v.score())
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        return healthy + [v for v in self.providers if not v.healthy]
+
+    def hedge_delay(self, stats: ProviderStats) -> Optional[float]:
+        if len(stats.latencies) < self.min_samples:
+            return None
+        return min(max(stats.percentile(self.hedge_percentile), self.hedge_min), self.hedge_max)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {v.name: v.as_dict() for v in self.providers}
+
+    @contextlib.asynccontextmanager
+    async def attempt(self, stats: ProviderStats, slot: Callable[[Any], AsyncContextManager] = None,
+                      on_start: Callable[[float], None] = None) -> AsyncIterator[None]:
+        """
+        Accounting of one call to the provider, whose breaker slot is already taken (ranked + allow, best).
+        Enters `slot(provider)` first: local queue wait is not the provider's latency
+        """
+        start = None
+        try:
+            async with slot(stats.provider) if slot is not None else contextlib.nullcontext():
+                start = time.monotonic()
+                if on_start is not None:
+                    on_start(start)
+                stats.in_flight += 1
+                try:
+                    yield
+                finally:
+                    stats.in_flight -= 1
+        except BaseException as E:
+            if start is None:
+                #never got to the provider
+                stats.breaker.release()
+            elif isinstance(E, Exception):
+                stats.record(time.monotonic() - start, False)
+            else:
+                stats.record_cancelled(time.monotonic() - start)
+            raise
+        stats.record(time.monotonic() - start, True)
+
+    async def __call(self, stats: ProviderStats, func: Callable[[Any], Awaitable[T]],
+                     slot: Optional[Callable[[Any], AsyncContextManager]], started: Dict[asyncio.Task, float]) -> T:
+        task = asyncio.current_task()
+        async with self.attempt(stats, slot, lambda start: started.__setitem__(task, start)):
+            return await func(stats.provider)
+
+    async def run(self, func: Callable[[Any], Awaitable[T]], slot: Callable[[Any], AsyncContextManager] = None,
+                  accept: Callable[[Any], bool] = None) -> T:
+        """
+        Calls `func(provider)` on the best provider, with hedging and failover.
+        `slot(provider)` is entered before each call (rate limiter), the hedge deadline starts once it is taken.
+        `accept(provider)` limits the request to providers that can serve it
+        """
+        queue = [v for v in self.ranked() if accept is None or accept(v.provider)]
+        if not queue:
+            raise ValueError("No provider can serve the request")
+        running: Dict[asyncio.Task, ProviderStats] = {}
+        started: Dict[asyncio.Task, float] = {} #task: time its call got to the provider
+        error: Optional[BaseException] = None
+
+        def launch():
+            stats = queue.pop(0)
+            #open circuit without a free probe is still used as the last resort
+            stats.breaker.allow()
+            running[asyncio.create_task(self.__call(stats, func, slot, started))] = stats
+            return stats
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if queue and len(running) == 1:
+                    task, stats = next(iter(running.items()))
+                    delay = self.hedge_delay(stats)
+                    if delay is not None:
+                        #still waiting for a local slot: check again shortly instead of hedging
+                        timeout = delay - (time.monotonic() - started[task]) if task in started else 0.05
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    task, stats = next(iter(running.items()))
+                    if task not in started or time.monotonic() - started[task] < self.hedge_delay(stats):
+                        continue
+                    stats = launch()
+                    logger.info(f"LLM request is slow, hedging with {stats.name}")
+                    continue
+
+                for task in done:
+                    stats = running.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    logger.warning(f"LLM provider {stats.name} failed: {error!r}")
+                if not running and queue:
+                    launch()
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+
+    def best(self) -> ProviderStats:
+        """Provider for requests that can't be hedged, the caller accounts the call with `attempt`"""
+        stats = self.ranked()[0]
+        stats.breaker.allow()
+        return stats
+
+    async def stream(self, func: Callable[[Any], AsyncIterator[T]], slot: Callable[[Any], AsyncContextManager] = None) -> AsyncIterator[T]:
+        """Yields from `func(provider)` of the best provider. A started stream can't be hedged or moved"""
+        stats = self.best()
+        async with self.attempt(stats, slot):
+            async for item in func(stats.provider):
+                yield item
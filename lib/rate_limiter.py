@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from lib.llm_cache import provider_name
+
+logger = logging.getLogger("ai_client")
+
+
+class TokenBucket:
+    """`rate` tokens per minute, up to `burst` saved for bursts"""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate / 60
+        self.capacity = burst or max(1, int(rate / 6)) #10 seconds worth by default
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available, 0 - right now"""
+        self.__refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.__refill()
+        self.tokens -= 1
+
+
+class _Lane:
+    """Waiters, running requests and metrics of one provider"""
+
+    def __init__(self, name: str, concurrency: int, bucket: Optional[TokenBucket], window: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = bucket
+        self.in_flight = 0
+        self.granted = 0
+        self.throttled = 0 #requests that waited for a token, not for a free slot
+        self.waiters: List[tuple] = [] #heap of (-priority, seq, future)
+        self.waits: Dict[int, deque] = {} #priority: recent queue waits
+        self.window = window
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def record_wait(self, priority: int, wait: float):
+        self.waits.setdefault(priority, deque(maxlen=self.window)).append(wait)
+
+    def as_dict(self) -> Dict[str, Any]:
+        waits = {}
+        for priority, values in sorted(self.waits.items(), reverse=True):
+            ordered = sorted(values)
+            waits[priority] = {
+                "p50": ordered[int(0.5 * (len(ordered) - 1))],
+                "p95": ordered[int(0.95 * (len(ordered) - 1))],
+                "max": ordered[-1],
+            }
+        return {
+            "in_flight": self.in_flight,
+            "waiting": sum(1 for v in self.waiters if not v[2].done()),
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "wait": waits,
+        }
+
+
+class RateLimiter:
+    """
+    Shared limiter of LLM requests across all games.
+
+    Every provider gets at most `concurrency` requests in flight (`provider_concurrency`
+    overrides it by provider name) and, with `rpm`, a token bucket of requests per minute.
+    Waiting requests are served by priority, higher first (see APIQueue.PRIORITY_*),
+    in arrival order within one priority. Queue waits are kept per priority for stats().
+    """
+
+    def __init__(self, concurrency: int = 4, rpm: float = None, burst: int = None,
+                 provider_concurrency: Dict[str, int] = None, window: int = 100):
+        self.concurrency = max(1, concurrency)
+        self.rpm = rpm
+        self.burst = burst
+        self.provider_concurrency = provider_concurrency or {}
+        self.window = window
+        self.lanes: Dict[str, _Lane] = {}
+        self._seq = itertools.count()
+
+    def lane(self, provider: Any) -> _Lane:
+        name = provider_name(provider) or "default"
+        lane = self.lanes.get(name)
+        if lane is None:
+            bucket = TokenBucket(self.rpm, self.burst) if self.rpm else None
+            lane = _Lane(name, max(1, self.provider_concurrency.get(name, self.concurrency)), bucket, self.window)
+            self.lanes[name] = lane
+        return lane
+
+    def __dispatch(self, lane: _Lane):
+        lane.timer = None
+        while lane.waiters and lane.in_flight < lane.concurrency:
+            if lane.waiters[0][2].done():
+                #cancelled while waiting
+                heapq.heappop(lane.waiters)
+                continue
+            if lane.bucket is not None:
+                delay = lane.bucket.delay()
+                if delay > 0:
+                    lane.throttled += 1
+                    lane.timer = asyncio.get_running_loop().call_later(delay, self.__dispatch, lane)
+                    return
+                lane.bucket.take()
+            _, _, future = heapq.heappop(lane.waiters)
+            lane.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, provider: Any = None, priority: int = 0) -> None:
+        """Waits for a free slot of the provider. Every acquire needs a `release`"""
+        lane = self.lane(provider)
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiters, (-priority, next(self._seq), future))
+        if lane.timer is None:
+            self.__dispatch(lane)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                #slot was granted right before the cancel
+                self.release(provider)
+            raise
+        lane.granted += 1
+        lane.record_wait(priority, time.monotonic() - start)
+
+    def release(self, provider: Any = None):
+        lane = self.lane(provider)
+        lane.in_flight -= 1
+        if lane.timer is None:
+            self.__dispatch(lane)
+
+    @asynccontextmanager
+    async def slot(self, provider: Any = None, priority: int = 0) -> AsyncIterator[None]:
+        await self.acquire(provider, priority)
+        try:
+            yield
+        finally:
+            self.release(provider)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: lane.as_dict() for name, lane in self.lanes.items()}
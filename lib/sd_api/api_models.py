@@ -1,136 +1,256 @@
 from pydantic import BaseModel, Field
 from typing import Optional
+from dataclasses import dataclass, field, fields
+from functools import cache
 from .shared import ImageToBase64
 from PIL import Image
 
 class SDModel(BaseModel):
     title: str
     mdl_name: str
-    hash: str
-    sha256: str
+    hash: Optional[str] = None #not calculated until model is loaded once
+    sha256: Optional[str] = None
     filename: str
-    config: Optional[str] #?
+    config: Optional[str] = None #?
+
+
+class SDSampler(BaseModel):
+    name: str
+    aliases: list[str] = Field(default_factory=list)
+    options: dict = Field(default_factory=dict)
+
+
+class SDUpscaler(BaseModel):
+    name: str
+    model_name: Optional[str] = None
+    model_path: Optional[str] = None
+    model_url: Optional[str] = None
+    scale: Optional[float] = None
 
 
 class SDProgress(BaseModel):
     progress: float = 0
     eta_relative: float = 0
-    state: Optional[dict]
-    current_image: Optional[str]
+    state: Optional[dict] = None
+    current_image: Optional[str] = None
     text_info: Optional[str] = None
+    current_task: Optional[str] = None #force_task_id of the running job, newer WebUI only
+
+
+@cache
+def _payload_fields(cls) -> tuple[str, ...]:
+    """Names of fields sent to WebUI, computed once per class"""
+    return tuple(f.name for f in fields(cls) if not f.metadata.get("client"))
+
+
+def _client_field(default):
+    #used only on our side, never sent to WebUI
+    return field(default=default, metadata={"client": True})
+
+
+#values WebUI uses when the field is missing. Only safe ones, so omitting them changes nothing
+TXT2IMG_SERVER_DEFAULTS = {
+    "prompt": "",
+    "negative_prompt": "",
+    "seed": -1,
+    "subseed": -1,
+    "subseed_strength": 0,
+    "seed_resize_from_h": -1,
+    "seed_resize_from_w": -1,
+    "batch_size": 1,
+    "n_iter": 1,
+    "cfg_scale": 7,
+    "width": 512,
+    "height": 512,
+    "override_settings_restore_afterwards": True,
+    "disable_extra_networks": False,
+    "enable_hr": False,
+    "firstphase_width": 0,
+    "firstphase_height": 0,
+    "hr_scale": 2,
+    "hr_second_pass_steps": 0,
+    "hr_resize_x": 0,
+    "hr_resize_y": 0,
+    "hr_prompt": "",
+    "hr_negative_prompt": "",
+    "script_args": [],
+    "send_images": True,
+    "save_images": False,
+    "alwayson_scripts": {},
+}
+
+IMG2IMG_SERVER_DEFAULTS = {
+    "prompt": "",
+    "negative_prompt": "",
+    "seed": -1,
+    "subseed": -1,
+    "subseed_strength": 0,
+    "batch_size": 1,
+    "n_iter": 1,
+    "cfg_scale": 7,
+    "width": 512,
+    "height": 512,
+    "override_settings_restore_afterwards": True,
+    "disable_extra_networks": False,
+    "resize_mode": 0,
+    "mask": None,
+    "mask_blur_x": 4,
+    "mask_blur_y": 4,
+    "inpainting_fill": 0,
+    "inpaint_full_res": True,
+    "inpaint_full_res_padding": 0,
+    "inpainting_mask_invert": 0,
+    "script_args": [],
+    "send_images": True,
+    "save_images": False,
+    "alwayson_scripts": {},
+}
+
 
+class _params_base():
+    __slots__ = ()
+    SERVER_DEFAULTS: dict = {}
 
-class txt2img_params():
-    prompt = ""
-    negative_prompt = ""
-    styles = []
-    seed = -1
-    subseed = -1
-    subseed_strength = 0
-    seed_resize_from_h = -1
-    seed_resize_from_w = -1
-    sampler_name = "Euler a"
-    batch_size = 1
-    n_iter = 1
-    steps = 28
-    cfg_scale = 7
-    width = 512
-    height = 512
-    restore_faces = False
-    tiling = False
-    do_not_save_samples = True
-    do_not_save_grid = True
-    eta = 0
-    denoising_strength = 0.75
-    s_min_uncond = 0
-    s_churn = 0
-    s_tmax = 0
-    s_tmin = 0
-    s_noise = 0
-    override_settings = {}
-    override_settings_restore_afterwards = True
-    refiner_checkpoint = ""
-    refiner_switch_at = 0
-    disable_extra_networks = False
-    comments = {}
-    enable_hr = False
-    firstphase_width = 0
-    firstphase_height = 0
-    hr_scale = 2
-    hr_upscaler = ""
-    hr_second_pass_steps = 0
-    hr_resize_x = 0
-    hr_resize_y = 0
-    hr_checkpoint_name = ""
-    hr_sampler_name = ""
-    hr_prompt = ""
-    hr_negative_prompt = ""
-    sampler_index = "Euler"
-    script_name = ""
-    script_args = []
-    send_images = True
-    save_images = False
-    alwayson_scripts = {}
-
-    def to_dict(self):
-        return {attr: getattr(self, attr) for attr in dir(self) if not callable(getattr(self, attr)) and not attr.startswith("__")}
+    def to_dict(self, omit_defaults = False) -> dict:
+        """
+        Payload for WebUI.
 
+        Args:
+            omit_defaults: Skip fields equal to WebUI defaults, makes payload smaller
+        """
+        if not omit_defaults:
+            return {name: getattr(self, name) for name in _payload_fields(type(self))}
+
+        defaults = self.SERVER_DEFAULTS
+        result = {}
+        for name in _payload_fields(type(self)):
+            value = getattr(self, name)
+            if name in defaults and defaults[name] == value:
+                continue
+            result[name] = value
+        return result
+
+    def is_deterministic(self) -> bool:
+        """Same params give the same image (no random seeds)"""
+        return self.seed != -1 and (self.subseed_strength == 0 or self.subseed != -1)
+
+
+@dataclass(slots=True)
+class txt2img_params(_params_base):
+    SERVER_DEFAULTS = TXT2IMG_SERVER_DEFAULTS
+
+    prompt: str = ""
+    negative_prompt: str = ""
+    styles: list = field(default_factory=list)
+    seed: int = -1
+    subseed: int = -1
+    subseed_strength: float = 0
+    seed_resize_from_h: int = -1
+    seed_resize_from_w: int = -1
+    sampler_name: str = "Euler a"
+    batch_size: int = 1
+    n_iter: int = 1
+    steps: int = 28
+    cfg_scale: float = 7
+    width: int = 512
+    height: int = 512
+    restore_faces: bool = False
+    tiling: bool = False
+    do_not_save_samples: bool = True
+    do_not_save_grid: bool = True
+    eta: float = 0
+    denoising_strength: float = 0.75
+    s_min_uncond: float = 0
+    s_churn: float = 0
+    s_tmax: float = 0
+    s_tmin: float = 0
+    s_noise: float = 0
+    override_settings: dict = field(default_factory=dict)
+    override_settings_restore_afterwards: bool = True
+    refiner_checkpoint: str = ""
+    refiner_switch_at: float = 0
+    disable_extra_networks: bool = False
+    comments: dict = field(default_factory=dict)
+    enable_hr: bool = False
+    firstphase_width: int = 0
+    firstphase_height: int = 0
+    hr_scale: float = 2
+    hr_upscaler: str = ""
+    hr_second_pass_steps: int = 0
+    hr_resize_x: int = 0
+    hr_resize_y: int = 0
+    hr_checkpoint_name: str = ""
+    hr_sampler_name: str = ""
+    hr_prompt: str = ""
+    hr_negative_prompt: str = ""
+    sampler_index: str = "Euler"
+    script_name: str = ""
+    script_args: list = field(default_factory=list)
+    send_images: bool = True
+    save_images: bool = False
+    alwayson_scripts: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True)
 class txt2img_sdupscale_params(txt2img_params):
-    upscaler="R-ESRGAN 4x+ Anime6B"
-    overlap=64
-    upscale_factor=2
-
-class img2img_params():
-    init_images=[]
-    prompt = ""
-    negative_prompt = ""
-    styles = []
-    seed = -1
-    subseed = -1
-    subseed_strength = 0
-    sampler_name = "Euler a"
-    batch_size = 1
-    n_iter = 1
-    steps = 22
-    cfg_scale = 7
-    width = 512
-    height = 512
-    restore_faces = False
-    tiling = False
-    do_not_save_samples = True
-    do_not_save_grid = True
-    denoising_strength = 0.4
-    override_settings = {}
-    override_settings_restore_afterwards = True
-    refiner_checkpoint = ""
-    refiner_switch_at = 0
-    disable_extra_networks = False
-    comments = {}
-    resize_mode = 0
-    image_cfg_scale = 0
-    mask = None
-    mask_blur_x = 4
-    mask_blur_y = 4
-    mask_blur = 0
-    inpainting_fill = 0
-    inpaint_full_res = True
-    inpaint_full_res_padding = 0
-    inpainting_mask_invert = 0
+    upscaler: str = _client_field("R-ESRGAN 4x+ Anime6B")
+    overlap: int = _client_field(64)
+    upscale_factor: float = _client_field(2)
+
+
+@dataclass(slots=True)
+class img2img_params(_params_base):
+    SERVER_DEFAULTS = IMG2IMG_SERVER_DEFAULTS
+
+    init_images: list = field(default_factory=list) #PIL or EncodedImage, converted to base64 in to_dict
+    prompt: str = ""
+    negative_prompt: str = ""
+    styles: list = field(default_factory=list)
+    seed: int = -1
+    subseed: int = -1
+    subseed_strength: float = 0
+    sampler_name: str = "Euler a"
+    batch_size: int = 1
+    n_iter: int = 1
+    steps: int = 22
+    cfg_scale: float = 7
+    width: int = 512
+    height: int = 512
+    restore_faces: bool = False
+    tiling: bool = False
+    do_not_save_samples: bool = True
+    do_not_save_grid: bool = True
+    denoising_strength: float = 0.4
+    override_settings: dict = field(default_factory=dict)
+    override_settings_restore_afterwards: bool = True
+    refiner_checkpoint: str = ""
+    refiner_switch_at: float = 0
+    disable_extra_networks: bool = False
+    comments: dict = field(default_factory=dict)
+    resize_mode: int = 0
+    image_cfg_scale: float = 0
+    mask: Optional[Image.Image] = None
+    mask_blur_x: int = 4
+    mask_blur_y: int = 4
+    mask_blur: int = 0
+    inpainting_fill: int = 0
+    inpaint_full_res: bool = True
+    inpaint_full_res_padding: int = 0
+    inpainting_mask_invert: int = 0
     # initial_noise_multiplier = 0
     # latent_mask = ""
     # sampler_index = "Euler"
     # include_init_images = False
-    script_name = ""
-    script_args = []
-    send_images = True
-    save_images = False
-    alwayson_scripts = {}
-
-    def to_dict(self):
-        self.init_images = [ImageToBase64(x) for x in self.init_images]
-        
-        if self.mask is not None:
-            self.mask = ImageToBase64(self.mask)
-
-        return {attr: getattr(self, attr) for attr in dir(self) if not callable(getattr(self, attr)) and not attr.startswith("__")}
-    
\ No newline at end of file
+    script_name: str = ""
+    script_args: list = field(default_factory=list)
+    send_images: bool = True
+    save_images: bool = False
+    alwayson_scripts: dict = field(default_factory=dict)
+
+    def to_dict(self, omit_defaults = False) -> dict:
+        result = _params_base.to_dict(self, omit_defaults)
+        #images are converted in the payload only, params stay reusable
+        result["init_images"] = [x if isinstance(x, str) else ImageToBase64(x) for x in self.init_images]
+        if self.mask is not None and not isinstance(self.mask, str):
+            result["mask"] = ImageToBase64(self.mask)
+        return result
@@ -0,0 +1,254 @@
+import aiohttp
+import asyncio, time, logging
+
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from .api_models import txt2img_params, txt2img_sdupscale_params, img2img_params, SDModel, SDProgress
+from .sd_api import WebUIApi, WebUIApiResult, ImageProgress, gather_upscales
+from .coalesce import RequestCoalescer, payload_key
+from .progress import ProgressCallback, ProgressFanout
+
+
+logger = logging.getLogger("sd_api")
+
+T = TypeVar("T")
+
+#errors that say "the node is sick", not "the request is bad"
+BACKEND_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+class SDBackend():
+    """One SD WebUI node and its routing state"""
+
+    def __init__(self, api: WebUIApi, slots = 1):
+        self.api = api
+        self.slots = slots
+
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.progress: Optional[SDProgress] = None
+        self.last_model: Optional[str] = None
+        self.latency = 0.0 #EWMA of job time
+
+    @property
+    def name(self) -> str:
+        return f"{self.api.host}:{self.api.port}"
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    def load(self) -> float:
+        """Queue depth estimate: our jobs in flight plus someone else's job running on the node"""
+        external = 0.0
+        if self.outstanding == 0 and self.progress is not None and self.progress.progress > 0:
+            #eta relative to our usual job time, capped to one job
+            external = min(self.progress.eta_relative / self.latency, 1.0) if self.latency > 0 else 1.0
+        return (self.outstanding + external) / self.slots
+
+    def has_model(self, model:str) -> bool:
+        """Unknown model list (discovery not done yet) is treated as "has everything" """
+        if not self.api.models:
+            return True
+        return any(model in (v.title, v.mdl_name, v.hash) for v in self.api.models)
+
+    def mark_success(self, elapsed:float = None):
+        if self.ejected_until:
+            logger.info(f"SD backend {self.name} is healthy again")
+        self.failures = 0
+        self.ejected_until = 0.0
+        if elapsed is not None:
+            self.latency = elapsed if self.latency == 0 else self.latency * 0.8 + elapsed * 0.2
+
+    def mark_failure(self, threshold:int, eject_time:float, error:Exception = None):
+        self.failures += 1
+        if self.failures >= threshold:
+            #logged once per outage, ejection is prolonged quietly until a success
+            if not self.ejected_until:
+                logger.error(f"SD backend {self.name} ejected after {self.failures} failures, last: {error!r}")
+            self.ejected_until = time.monotonic() + eject_time
+
+
+class WebUIPool():
+    """Routes requests over several SD WebUI nodes. Has the same generation interface as `WebUIApi`"""
+
+    def __init__(self, apis: list[WebUIApi], slots = 1, health_interval = 10, failure_threshold = 2, eject_time = 60):
+        if not apis:
+            raise ValueError("WebUIPool needs at least one backend")
+        self.backends = [SDBackend(api, slots) for api in apis]
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.eject_time = eject_time
+        self._health_task: Optional[asyncio.Task] = None
+        self._probing = False #every node is ejected, logged once
+        self.coalescer = RequestCoalescer()
+        self._fanouts: dict[str, ProgressFanout] = {} #progress of coalesced jobs, by coalescing key
+
+    @classmethod
+    def from_hosts(cls, hosts:str, **kwargs) -> "WebUIPool":
+        """Builds pool from string like "host1:7860,host2:7860" """
+        pool_keys = ("slots", "health_interval", "failure_threshold", "eject_time")
+        pool_kwargs = {k: kwargs.pop(k) for k in pool_keys if k in kwargs}
+
+        apis = []
+        for host in hosts.split(","):
+            host = host.strip()
+            if not host:
+                continue
+            name, _, port = host.partition(":")
+            apis.append(WebUIApi(name, int(port or 7860), **kwargs))
+        return cls(apis, **pool_kwargs)
+
+    @property
+    def size(self) -> int:
+        return sum(v.slots for v in self.backends)
+
+    async def open(self):
+        for backend in self.backends:
+            await backend.api.open()
+
+    async def close(self):
+        self.stop_discovery()
+        for backend in self.backends:
+            await backend.api.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    #health checks
+    async def check_backend(self, backend: SDBackend):
+        try:
+            backend.progress = await asyncio.wait_for(backend.api.get_progress(), self.health_interval)
+            backend.mark_success()
+        except Exception as E:
+            #state changes are logged by mark_failure / mark_success
+            logger.debug(f"Health check of SD backend {backend.name} failed: {E}")
+            backend.mark_failure(self.failure_threshold, self.eject_time, E)
+
+    async def __health_loop(self):
+        while True:
+            await asyncio.gather(*[self.check_backend(v) for v in self.backends])
+            await asyncio.sleep(self.health_interval)
+
+    def start_discovery(self):
+        """Starts model discovery on every node and active health checks"""
+        for backend in self.backends:
+            backend.api.start_discovery()
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self.__health_loop())
+
+    def stop_discovery(self):
+        for backend in self.backends:
+            backend.api.stop_discovery()
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+    async def update_models(self, force = False):
+        await asyncio.gather(*[v.api.update_models(force) for v in self.backends])
+
+    def get_models(self) -> list[SDModel]:
+        result = {}
+        for backend in self.backends:
+            for model in backend.api.models:
+                result.setdefault(model.title, model)
+        return list(result.values())
+
+    def validate_sampler(self, name:str) -> bool:
+        return any(v.api.validate_sampler(name) for v in self.backends)
+
+    #routing
+    def pick(self, model:str = None, exclude:set = ()) -> SDBackend:
+        candidates = [v for v in self.backends if not v.ejected and v not in exclude]
+        probing = not candidates
+        if probing:
+            #everything is ejected: probe the one that comes back first instead of failing hard
+            candidates = [v for v in self.backends if v not in exclude]
+            if not candidates:
+                raise NoBackendAvailable("Нет доступных серверов Stable Diffusion")
+            if not self._probing:
+                logger.warning("Every SD backend is ejected, probing the one that comes back first")
+        self._probing = probing
+
+        if model:
+            with_model = [v for v in candidates if v.has_model(model)]
+            if not with_model:
+                raise NoBackendAvailable(f"Модель {model} не найдена ни на одном сервере")
+            candidates = with_model
+
+        if probing:
+            return min(candidates, key=lambda v: v.ejected_until)
+
+        def score(backend: SDBackend):
+            #switching checkpoints costs more than waiting a bit
+            swap = 0.5 if model and backend.last_model not in (None, model) else 0
+            return (backend.load() + swap, backend.latency)
+
+        return min(candidates, key=score)
+
+    async def run(self, func: Callable[[WebUIApi], Awaitable[T]], model:str = None) -> T:
+        """Runs `func` on the best node. Connection-level failure is retried once on another node"""
+        tried = set()
+        while True:
+            backend = self.pick(model, tried)
+            tried.add(backend)
+
+            backend.outstanding += 1
+            start = time.monotonic()
+            try:
+                result = await func(backend.api)
+            except BACKEND_ERRORS as E:
+                backend.mark_failure(self.failure_threshold, self.eject_time, E)
+                if len(tried) >= min(2, len(self.backends)):
+                    raise
+                logger.warning(f"SD backend {backend.name} failed: {E}. Retrying on another one")
+                continue
+            finally:
+                backend.outstanding -= 1
+
+            backend.mark_success(time.monotonic() - start)
+            if model:
+                backend.last_model = model
+            return result
+
+    @staticmethod
+    def _model_of(params) -> Optional[str]:
+        return (params.override_settings or {}).get("sd_model_checkpoint")
+
+    async def txt2img(self, params: txt2img_params, on_progress: ProgressCallback = None, preview = False) -> WebUIApiResult:
+        model = self._model_of(params)
+        if not params.is_deterministic():
+            return await self.run(lambda api: api.txt2img(params, on_progress, preview), model)
+
+        #dedupe before routing, so identical requests don't land on different nodes
+        key = payload_key(params.to_dict())
+        fanout = self._fanouts.get(key)
+        if fanout is None:
+            fanout = self._fanouts[key] = ProgressFanout()
+        #every caller of the shared job gets progress while it waits, previews only if the first caller asked
+        factory = lambda: self.run(lambda api: api.txt2img(params, fanout, preview), model)
+        try:
+            with fanout.subscription(on_progress, preview):
+                return await self.coalescer.run(key, factory)
+        finally:
+            if fanout.users == 0 and self._fanouts.get(key) is fanout:
+                del self._fanouts[key]
+
+    async def img2img(self, params: img2img_params, on_progress: ProgressCallback = None, preview = False) -> WebUIApiResult:
+        return await self.run(lambda api: api.img2img(params, on_progress, preview), self._model_of(params))
+
+    async def txt2img_sdupscale(self, params: txt2img_sdupscale_params, on_image: ImageProgress = None) -> WebUIApiResult:
+        response = await self.txt2img(params)
+        #every image goes to the least loaded node, upscaler index is resolved on that node
+        model = self._model_of(params)
+        jobs = [lambda img=img: self.run(lambda api: api.sdupscale_image(img, params), model) for img in response.images]
+        return WebUIApiResult(await gather_upscales(jobs, on_image), response.parameters, response.info)
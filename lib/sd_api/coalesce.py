@@ -0,0 +1,47 @@
+import asyncio, hashlib, json
+
+from typing import Awaitable, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+
+def payload_key(payload: dict) -> str:
+    """Canonical hash of the request payload"""
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class RequestCoalescer():
+    """Shares one in-flight call (and its result) between concurrent identical requests"""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._waiters: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __forget(self, key:str, task:asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+
+    async def run(self, key:str, factory: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self.__forget(key, t))
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            #last one leaving turns off the lights
+            if not task.done() and self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] < 1:
+                    task.cancel()
+            raise
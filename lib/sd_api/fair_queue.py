@@ -0,0 +1,108 @@
+import asyncio, itertools
+
+from dataclasses import dataclass
+from typing import Any, Hashable
+
+
+class FairQueue():
+    """
+    Async queue with priority classes and start-time fair queuing inside a class.
+
+    Every item belongs to a flow (user, guild...). A flow with a long backlog gets
+    its items spread out in virtual time, so a newcomer flow is served right after
+    the item currently being processed instead of after the whole backlog.
+    Flow weight N gives the flow N times more turns.
+    """
+
+    @dataclass
+    class Entry():
+        item: Any
+        flow: Hashable
+        priority: int
+        start: float
+        seq: int
+
+        @property
+        def key(self):
+            return (-self.priority, self.start, self.seq)
+
+    def __init__(self, maxsize = 0, weights:dict = None):
+        self.maxsize = maxsize
+        self.weights = weights or {}
+
+        self._entries: list[FairQueue.Entry] = []
+        self._finish: dict = {} #virtual finish time of the last item per flow
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._changed = asyncio.Condition()
+        self._background: set[asyncio.Task] = set() #keeps wakeup tasks alive until they finish
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def empty(self) -> bool:
+        return not self._entries
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._entries)
+
+    def ordered(self) -> list:
+        """Waiting items in the order they are going to be served"""
+        return [v.item for v in sorted(self._entries, key=lambda v: v.key)]
+
+    def position(self, item) -> int:
+        """Zero based place of the item in line, -1 if not waiting"""
+        for i, v in enumerate(self.ordered()):
+            if v is item:
+                return i
+        return -1
+
+    def put_nowait(self, item, flow:Hashable = None, priority = 0):
+        if self.full():
+            raise asyncio.QueueFull
+        weight = self.weights.get(flow, 1)
+        start = max(self._vtime, self._finish.get(flow, 0.0))
+        self._finish[flow] = start + 1 / weight
+        self._entries.append(self.Entry(item, flow, priority, start, next(self._seq)))
+
+    async def put(self, item, flow:Hashable = None, priority = 0):
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self.full())
+            self.put_nowait(item, flow, priority)
+            self._changed.notify_all()
+
+    def get_nowait(self):
+        if not self._entries:
+            raise asyncio.QueueEmpty
+        entry = min(self._entries, key=lambda v: v.key)
+        self._entries.remove(entry)
+        self._vtime = max(self._vtime, entry.start)
+
+        #forget idle flows, their finish time is in the past anyway
+        waiting = {v.flow for v in self._entries}
+        for flow in [k for k, v in self._finish.items() if v <= self._vtime and k not in waiting]:
+            del self._finish[flow]
+        return entry.item
+
+    async def get(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self.empty())
+            item = self.get_nowait()
+            self._changed.notify_all()
+            return item
+
+    def remove_nowait(self, item) -> bool:
+        """Drops waiting item. Returns False if it is not in the queue"""
+        for entry in self._entries:
+            if entry.item is item:
+                self._entries.remove(entry)
+                #putters waiting for free space are woken up outside of the caller
+                task = asyncio.get_running_loop().create_task(self.__wakeup())
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+                return True
+        return False
+
+    async def __wakeup(self):
+        async with self._changed:
+            self._changed.notify_all()
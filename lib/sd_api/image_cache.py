@@ -0,0 +1,137 @@
+import asyncio, hashlib, json, logging, mmap, os, threading
+
+from collections import OrderedDict
+from typing import Optional
+
+
+logger = logging.getLogger("sd_api")
+
+
+class ImageCache():
+    """
+    Content-addressed cache of generated images on disk.
+
+    One entry is one file: 4 bytes header length, json header (offsets of images,
+    parameters and info of the result), then encoded images as returned by WebUI.
+    Entries are evicted least recently used first when `max_bytes` is exceeded.
+    """
+
+    SUFFIX = ".sdc"
+
+    def __init__(self, root = "cache/images", max_bytes = 1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._index: OrderedDict[str, int] = OrderedDict() #key: file size, oldest first
+        self._total = 0
+        self.__load_index()
+
+    @staticmethod
+    def make_key(model_hash:str, params_hash:str, seed:int) -> str:
+        return hashlib.sha256(f"{model_hash}:{params_hash}:{seed}".encode("utf-8")).hexdigest()
+
+    @property
+    def size(self) -> int:
+        return self._total
+
+    def __path(self, key:str) -> str:
+        return os.path.join(self.root, key[:2], key + self.SUFFIX)
+
+    def __load_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(self.SUFFIX):
+                    continue
+                stat = os.stat(os.path.join(dirpath, name))
+                entries.append((stat.st_mtime, name[:-len(self.SUFFIX)], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total += size
+        self.__evict()
+
+    def __evict(self):
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self.__path(key))
+            except OSError as E:
+                logger.warning(f"Error removing cached image {key}: {E}")
+
+    def __contains__(self, key:str) -> bool:
+        return key in self._index
+
+    def get_sync(self, key:str) -> Optional[tuple[list[bytes], dict, dict]]:
+        """Returns (images, parameters, info) or None"""
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                header_len = int.from_bytes(data[:4], "little")
+                header = json.loads(data[4:4 + header_len])
+                base = 4 + header_len
+                images = [bytes(data[base + start:base + end]) for start, end in header["images"]]
+            os.utime(path) #keep recency after restart
+        except (OSError, ValueError, KeyError) as E:
+            logger.warning(f"Broken cached image {key}, dropping it: {E}")
+            self.remove(key)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return images, header.get("parameters"), header.get("info")
+
+    def put_sync(self, key:str, images:list[bytes], parameters = None, info = None):
+        offsets = []
+        pos = 0
+        for data in images:
+            offsets.append((pos, pos + len(data)))
+            pos += len(data)
+        header = json.dumps({"images": offsets, "parameters": parameters, "info": info}, default=str).encode("utf-8")
+
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(len(header).to_bytes(4, "little"))
+            f.write(header)
+            for data in images:
+                f.write(data)
+        os.replace(tmp, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self.__evict()
+
+    def remove(self, key:str):
+        with self._lock:
+            size = self._index.pop(key, None)
+            if size is None:
+                return
+            self._total -= size
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+    async def get(self, key:str) -> Optional[tuple[list[bytes], dict, dict]]:
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key:str, images:list[bytes], parameters = None, info = None):
+        await asyncio.to_thread(self.put_sync, key, images, parameters, info)
@@ -0,0 +1,166 @@
+import asyncio, base64, logging, random, time
+
+from io import BytesIO
+from typing import Optional
+from aiohttp import web
+from PIL import Image
+
+
+logger = logging.getLogger("sd_api")
+
+
+class MockWebUI():
+    """
+    Stand-in for SD WebUI API to measure the image path without a GPU.
+
+    A job holds one of `slots` "GPUs" for `latency` (+- `jitter`) seconds per image,
+    fails with HTTP 500 with `failure_rate` probability and returns noise PNGs of about `payload_size` bytes.
+    """
+
+    MODELS = [
+        {"title": "mock_xl.safetensors [0000000001]", "model_name": "mock_xl", "hash": "0000000001",
+         "sha256": None, "filename": "/models/mock_xl.safetensors", "config": None},
+    ]
+    SAMPLERS = [{"name": "Euler a", "aliases": ["k_euler_a"], "options": {}}, {"name": "DPM++ 2M", "aliases": [], "options": {}}]
+    UPSCALERS = [{"name": "None", "scale": 1}, {"name": "Lanczos", "scale": 4}, {"name": "R-ESRGAN 4x+", "scale": 4}]
+
+    def __init__(self, latency = 1.0, jitter = 0.1, failure_rate = 0.0, payload_size = 256 * 1024, slots = 1, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.slots = asyncio.Semaphore(slots)
+        self.random = random.Random(seed)
+        self.image_b64 = self.make_image(payload_size)
+
+        self.requests = 0
+        self.failures = 0
+        self.interrupts = 0
+        self._job_start = 0.0
+        self._job_time = 0.0
+        self._current_task: Optional[str] = None
+        self._interrupted = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+
+    def make_image(self, payload_size: int) -> str:
+        """Noise doesn't compress, so PNG size is about width * height * 3"""
+        side = max(8, int((payload_size / 3) ** 0.5))
+        img = Image.frombytes("RGB", (side, side), self.random.randbytes(side * side * 3))
+        buf = BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+        return base64.b64encode(buf.getvalue()).decode("ascii")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([
+            web.get("/sdapi/v1/sd-models", self.models),
+            web.get("/sdapi/v1/samplers", self.samplers),
+            web.get("/sdapi/v1/upscalers", self.upscalers),
+            web.get("/sdapi/v1/options", self.options),
+            web.get("/sdapi/v1/progress", self.progress),
+            web.post("/sdapi/v1/txt2img", self.generate),
+            web.post("/sdapi/v1/img2img", self.generate),
+            web.post("/sdapi/v1/interrupt", self.interrupt),
+        ])
+        return app
+
+    async def start(self, host = "127.0.0.1", port = 0) -> int:
+        """Starts serving in the current loop. Returns the port (random free one if 0)"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @staticmethod
+    def image_count(payload: dict) -> int:
+        count = max(1, payload.get("batch_size", 1)) * max(1, payload.get("n_iter", 1))
+        args = payload.get("script_args") or []
+        if str(payload.get("script_name", "")).lower() == "prompts from file or textbox" and len(args) >= 4:
+            count *= len([v for v in str(args[3]).splitlines() if v.strip()])
+        return count
+
+    async def generate(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.requests += 1
+        count = self.image_count(payload)
+
+        async with self.slots:
+            duration = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)) * count
+            self._job_start, self._job_time = time.monotonic(), duration
+            self._current_task = payload.get("force_task_id")
+            self._interrupted.clear()
+            try:
+                await asyncio.wait_for(self._interrupted.wait(), duration)
+                self.interrupts += 1
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._job_time = 0.0
+
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({"error": "MockFailure", "detail": "injected failure"}, status=500)
+
+        images = [self.image_b64] * (count + (1 if count > 1 else 0)) #grid goes first, like WebUI
+        parameters = {k: v for k, v in payload.items() if k not in ("init_images", "mask")}
+        return web.json_response({"images": images, "parameters": parameters, "info": "{}"})
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response(self.MODELS)
+
+    async def samplers(self, request: web.Request) -> web.Response:
+        return web.json_response(self.SAMPLERS)
+
+    async def upscalers(self, request: web.Request) -> web.Response:
+        return web.json_response(self.UPSCALERS)
+
+    async def options(self, request: web.Request) -> web.Response:
+        return web.json_response({"sd_model_checkpoint": self.MODELS[0]["title"]})
+
+    async def progress(self, request: web.Request) -> web.Response:
+        if self._job_time <= 0:
+            return web.json_response({"progress": 0, "eta_relative": 0, "state": {"job_count": 0}, "current_image": None})
+        elapsed = time.monotonic() - self._job_start
+        current = None if request.query.get("skip_current_image", "False") == "True" else self.image_b64
+        return web.json_response({
+            "progress": min(elapsed / self._job_time, 1.0),
+            "eta_relative": max(self._job_time - elapsed, 0.0),
+            "state": {"job_count": 1},
+            "current_image": current,
+            "current_task": self._current_task,
+        })
+
+    async def interrupt(self, request: web.Request) -> web.Response:
+        self._interrupted.set()
+        return web.json_response({})
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mock SD WebUI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per image")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--payload-kb", type=int, default=256)
+    parser.add_argument("--slots", type=int, default=1, help="jobs processed at the same time")
+    args = parser.parse_args()
+
+    async def main():
+        server = MockWebUI(args.latency, args.jitter, args.failure_rate, args.payload_kb * 1024, args.slots)
+        port = await server.start(args.host, args.port)
+        print(f"Mock SD WebUI on http://{args.host}:{port}/sdapi/v1")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
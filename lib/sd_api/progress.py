@@ -0,0 +1,125 @@
+import asyncio, logging
+
+from io import BytesIO
+from typing import Awaitable, Callable, Optional
+from contextlib import contextmanager
+
+from .api_models import SDProgress
+from .shared import EncodedImage
+
+
+logger = logging.getLogger("sd_api")
+
+#callback(progress, preview), preview is None unless asked for
+ProgressCallback = Callable[[SDProgress, Optional[EncodedImage]], Awaitable[None]]
+
+
+async def notify_subscribers(subscribers: list[tuple[ProgressCallback, bool]], progress: SDProgress, preview: Optional[EncodedImage]):
+    """Calls every (callback, wants preview), one failing callback doesn't stop the rest"""
+    async def notify(callback: ProgressCallback, wants: bool):
+        try:
+            await callback(progress, preview if wants else None)
+        except Exception as E:
+            logger.error(f"Error in progress callback: {E}")
+
+    await asyncio.gather(*[notify(callback, wants) for callback, wants in subscribers])
+
+
+def make_preview(current_image: str, max_side: int) -> EncodedImage:
+    """Downscales base64 image from /progress into small JPEG"""
+    image = EncodedImage.from_base64(current_image).image
+    image.thumbnail((max_side, max_side))
+    buffered = BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=70)
+    return EncodedImage(buffered.getvalue())
+
+
+class ProgressFanout():
+    """
+    One progress callback that forwards to every subscriber,
+    for a job shared by several callers (coalesced requests)
+    """
+
+    def __init__(self):
+        self.users = 0 #callers waiting for the shared job, with or without callback
+        self._subscribers: dict[int, tuple[ProgressCallback, bool]] = {}
+        self._ids = 0
+
+    @contextmanager
+    def subscription(self, callback: Optional[ProgressCallback], preview = False):
+        self.users += 1
+        sub_id = None
+        if callback is not None:
+            self._ids += 1
+            sub_id = self._ids
+            self._subscribers[sub_id] = (callback, preview)
+        try:
+            yield
+        finally:
+            self.users -= 1
+            self._subscribers.pop(sub_id, None)
+
+    async def __call__(self, progress: SDProgress, preview: Optional[EncodedImage]):
+        await notify_subscribers(list(self._subscribers.values()), progress, preview)
+
+
+class ProgressHub():
+    """
+    Polls /progress of one node only while somebody listens
+    and fans every answer out to all subscribers.
+    """
+
+    def __init__(self, api, interval = 1.5, preview_size = 256):
+        self.api = api
+        self.interval = interval
+        self.preview_size = preview_size
+        self.last: Optional[SDProgress] = None
+
+        self._subscribers: dict[int, tuple[ProgressCallback, bool]] = {}
+        self._ids = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, callback: ProgressCallback, preview = False) -> int:
+        self._ids += 1
+        self._subscribers[self._ids] = (callback, preview)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__poll())
+        return self._ids
+
+    def unsubscribe(self, sub_id: int):
+        self._subscribers.pop(sub_id, None)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @contextmanager
+    def subscription(self, callback: Optional[ProgressCallback], preview = False):
+        """Subscribes for the duration of `with` block. None callback does nothing"""
+        if callback is None:
+            yield
+            return
+        sub_id = self.subscribe(callback, preview)
+        try:
+            yield
+        finally:
+            self.unsubscribe(sub_id)
+
+    async def __poll(self):
+        while self._subscribers:
+            await asyncio.sleep(self.interval)
+            want_preview = any(preview for _, preview in self._subscribers.values())
+            try:
+                progress = await self.api.get_progress(skip_current_image=not want_preview)
+            except Exception as E:
+                logger.warning(f"Error getting progress: {E}")
+                continue
+            self.last = progress
+
+            preview = None
+            if want_preview and progress.current_image:
+                try:
+                    preview = await asyncio.to_thread(make_preview, progress.current_image, self.preview_size)
+                except Exception as E:
+                    logger.warning(f"Error making preview: {E}")
+
+            await notify_subscribers(list(self._subscribers.values()), progress, preview)
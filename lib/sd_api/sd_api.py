@@ -1,22 +1,25 @@
-import aiohttp, requests
-import asyncio
+import aiohttp
+import asyncio, time, uuid
 
 
-import json, io, base64, logging
-from PIL import Image
+import json, base64, logging
 
-from typing import Coroutine, Optional
+from typing import Awaitable, Callable, Coroutine, Optional
 from pydantic import ValidationError
 from dataclasses import dataclass
+from concurrent.futures import Executor
 
-from .api_models import txt2img_params, txt2img_sdupscale_params, img2img_params, SDModel, SDProgress
+from .fair_queue import FairQueue
+from .coalesce import RequestCoalescer, payload_key
+from .image_cache import ImageCache
+from .shared import EncodedImage
+from .progress import ProgressHub, ProgressCallback
+from .api_models import txt2img_params, txt2img_sdupscale_params, img2img_params, SDModel, SDSampler, SDUpscaler, SDProgress
 
 
 logger = logging.getLogger("sd_api")
 
-from builtins import BaseException
-
-class MaxQueueReached(BaseException):
+class MaxQueueReached(Exception):
     def __init__(self, *args):
         if args: self.message = args[0]
 
@@ -25,6 +28,19 @@ class MaxQueueReached(BaseException):
         else: return "MaxQueueReached"
 
 
+class JobCancelled(Exception):
+    """Job was cancelled through APIQueue.cancel before it finished"""
+    pass
+
+
+class WebUIHTTPError(RuntimeError):
+    """WebUI answered a generation request with non 200 status"""
+    def __init__(self, status: int, text: str):
+        super().__init__(status, text)
+        self.status = status
+        self.text = text
+
+
 class StyleFactory():
     def __init__(self):
         self.styles = {}
@@ -86,33 +102,65 @@ class StyleFactory():
 
 
 class APIQueue():
-    def __init__(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2):
-        self.busy = False
-        self.configure(def_limit, custom_limits, max_tasks, update_sleep)
+    #priority classes, higher goes first
+    PRIORITY_HIGH = 10 #needed to start a game
+    PRIORITY_NORMAL = 0
+    PRIORITY_LOW = -10 #optional extras
+
+    def __init__(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2, workers = 1, weights:dict = {}):
+        self.running = 0
+        self.active: set = set() #running Params
+        self.configure(def_limit, custom_limits, max_tasks, update_sleep, workers, weights)
 
-    def configure(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2):
+    def configure(self, def_limit = 4, custom_limits:dict = {}, max_tasks = 10, update_sleep = 2, workers = 1, weights:dict = {}):
         self.limit = def_limit
         self.custom_limits = custom_limits
         self.update_sleep = update_sleep
+        self.workers = workers #jobs in flight at once, match it to GPU slots of the backend
 
-        self.queue = asyncio.Queue(max_tasks)
+        #fair share between flows (group or uid), weights: {flow: weight}
+        self.queue = FairQueue(max_tasks, weights)
         self.counts = {}
 
-    @dataclass
+    @dataclass(eq=False)
     class Params():
-        uid: str
+        uid: str #None - not limited
         func: Coroutine
         update_func: Coroutine = None
         end_func: Coroutine = None
+        priority: int = 0
+        group: str = None #fair share flow (guild, channel), uid if not set
+        future: Optional[asyncio.Future] = None #set by `submit`
+        task: Optional[asyncio.Task] = None #running job, set by worker
+
+        @property
+        def flow(self):
+            return self.group if self.group is not None else self.uid
+
+    @property
+    def busy(self) -> bool:
+        return self.running > 0
 
     def size(self) -> int:
         return self.queue.qsize()
     
-    def human_size(self) -> int:
-        count = self.size()+1
-        if self.busy:
+    def __human_position(self, index:int) -> int:
+        #1 - starts right away, +1 while every worker is busy
+        count = index + 1
+        if self.running >= self.workers:
             count += 1
         return count
+
+    def human_size(self) -> int:
+        """Position that new request will get"""
+        return self.__human_position(self.size())
+
+    def position(self, params:Params) -> int:
+        """Position of the waiting request, 0 if it is not waiting anymore"""
+        index = self.queue.position(params)
+        if index < 0:
+            return 0
+        return self.__human_position(index)
         
     async def __get_one(self) -> Params:
         return await self.queue.get()
@@ -128,217 +176,534 @@ class APIQueue():
             
             finally:
                 await asyncio.sleep(self.update_sleep) 
-            
 
-    async def process_requests(self):
-        update_task = None
+    def __release(self, uid):
+        #check user counter
+        if uid in self.counts:
+            self.counts[uid] -= 1
+            if self.counts[uid] < 1:
+                del self.counts[uid]
 
+    async def __worker(self):
         while True:
             params = await self.__get_one()
-            uid = params.uid
-            coro = params.func
-            update_coro = params.update_func
-            end_func = params.end_func
+            future = params.future
 
-            # Update worker
-            if update_coro and update_task is None:
-                update_task = asyncio.create_task(self.__process_update(update_coro))
+            # Update worker, one per running job
+            update_task = None
+            if params.update_func:
+                update_task = asyncio.create_task(self.__process_update(params.update_func))
 
+            result = None
             try:
-                self.busy = True
-                result = await coro()
+                self.running += 1
+                self.active.add(params)
+                #separate task, so a job can be cancelled without killing the worker
+                params.task = asyncio.ensure_future(params.func())
+                await asyncio.wait([params.task])
+
+                if params.task.cancelled():
+                    if future is not None and not future.done():
+                        future.set_exception(JobCancelled())
+                    continue
+                
+                result = params.task.result()
+                if future is not None and not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                #worker is shutting down
+                if params.task is not None:
+                    params.task.cancel()
+                raise
+            except Exception as E:
+                if future is not None and not future.done():
+                    future.set_exception(E)
+                else:
+                    logger.error(f"Error occured in SD_API queue: {E}")
             finally:
-                self.busy = False
-                self.queue.task_done() #end task
-
-                #check user counter
-                if uid in self.counts:
-                    self.counts[uid] -= 1
-                    if self.counts[uid] < 1:
-                        del self.counts[uid]
+                self.running -= 1
+                self.active.discard(params)
+                self.__release(params.uid)
 
                 if update_task is not None:
                     update_task.cancel()
-                    update_task = None
 
-                if end_func is not None:
-                    await end_func(result)
+            if params.end_func is not None:
+                try:
+                    await params.end_func(result)
+                except Exception as E:
+                    logger.error(f"Error occured in SD_API end function: {E}")
+
+    async def process_requests(self):
+        workers = [asyncio.create_task(self.__worker()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
 
     async def put(self, params:Params):
         uid = params.uid
 
-        if uid not in self.counts:
-            self.counts[uid] = 0
+        if uid is not None:
+            if uid not in self.counts:
+                self.counts[uid] = 0
 
-        max_count = self.limit
-        if uid in self.custom_limits:
-            max_count = self.custom_limits[uid]
+            max_count = self.limit
+            if uid in self.custom_limits:
+                max_count = self.custom_limits[uid]
 
-        if self.counts[uid] >= max_count:
-            raise MaxQueueReached("Максимальное количество одновременных запросов достигнуто")
-        
-        self.counts[uid] += 1
-        await self.queue.put(params)
+            if self.counts[uid] >= max_count:
+                raise MaxQueueReached("Максимальное количество одновременных запросов достигнуто")
+            
+            self.counts[uid] += 1
+
+        try:
+            await self.queue.put(params, params.flow, params.priority)
+        except BaseException:
+            self.__release(uid)
+            raise
+
+    async def submit(self, params:Params):
+        """Puts request into the queue and waits for its result. Raises JobCancelled if the job is cancelled"""
+        params.future = asyncio.get_running_loop().create_future()
+        await self.put(params)
+        try:
+            return await params.future
+        except asyncio.CancelledError:
+            #nobody waits for the result anymore
+            self.cancel(params)
+            raise
+
+    def cancel(self, params:Params) -> bool:
+        """
+        Cancels waiting or running job and frees its uid slot.
+        Running job gets CancelledError, WebUIApi interrupts generation on it.
+        Returns False if the job is already finished.
+        """
+        if self.queue.remove_nowait(params):
+            self.__release(params.uid)
+            if params.future is not None and not params.future.done():
+                params.future.set_exception(JobCancelled())
+            return True
+
+        if params.task is not None and not params.task.done():
+            params.task.cancel()
+            return True
+        return False
+
+    def cancel_where(self, uid = None, group = None) -> int:
+        """Cancels every waiting and running job of the uid and/or group. Returns number of cancelled jobs"""
+        def match(params:APIQueue.Params) -> bool:
+            return (uid is None or params.uid == uid) and (group is None or params.group == group)
+
+        if uid is None and group is None:
+            return 0
+        jobs = [v for v in self.queue.ordered() + list(self.active) if match(v)]
+        return sum(1 for v in jobs if self.cancel(v))
+
+
+
+def parse_api_response(body: bytes) -> tuple[list[bytes], dict, dict]:
+    """Parses WebUI json answer into (encoded images, parameters, info). CPU heavy, runs in executor"""
+    r = json.loads(body)
+    encoded = []
+    if 'images' in r.keys():
+        encoded = [base64.b64decode(i) for i in r['images']]
+    elif 'image' in r.keys():
+        encoded = [base64.b64decode(r['image'])]
+    
+    info = ''
+    if 'info' in r.keys():
+        try:
+            info = json.loads(r['info'])
+        except:
+            info = r['info']
+    elif 'html_info' in r.keys():
+        info = r['html_info']
+
+    parameters = ''
+    if 'parameters' in r.keys():
+        parameters = r['parameters']
+
+    return encoded, parameters, info
+
+
+#on_image(done, total), called after every upscaled image
+ImageProgress = Callable[[int, int], Awaitable[None]]
+
+def sdupscale_params(img: EncodedImage, params: txt2img_sdupscale_params, upscaler_id: int) -> img2img_params:
+    pr = img2img_params()
+    pr.init_images = [img]
+    pr.prompt = "best quality, good quality, hdr, masterpiece" #params.prompt
+    pr.negative_prompt = "(worst quality, low quality:1.4), (blurry:1.2), (lowres), (deformed, distorted, disfigured:1.3), (bad hands:1.1), jpeg compression, bad image" #params.negative_prompt
+    pr.steps = 15
+    pr.width = params.width
+    pr.height = params.height
+    pr.batch_size = 3
+    pr.denoising_strength = 0.3
+    pr.cfg_scale = params.cfg_scale
+
+    pr.script_name = "SD Upscale"
+    pr.script_args = ["_", params.overlap, upscaler_id, params.upscale_factor]
+    return pr
+
+async def gather_upscales(jobs: list[Callable[[], Awaitable[EncodedImage]]], on_image: ImageProgress = None) -> list[EncodedImage]:
+    """Runs upscale jobs concurrently, keeps order of results"""
+    done = 0
+
+    async def run(job):
+        nonlocal done
+        image = await job()
+        done += 1
+        if on_image is not None:
+            try:
+                await on_image(done, len(jobs))
+            except Exception as E:
+                logger.error(f"Error in upscale progress callback: {E}")
+        return image
 
+    return list(await asyncio.gather(*[run(job) for job in jobs]))
 
 
 @dataclass
 class WebUIApiResult:
-    images: list[Image.Image]
+    images: list[EncodedImage] #decoded lazily, see EncodedImage.image
     parameters: dict
     info: dict
         
     @property
-    def image(self) -> Image.Image:
+    def image(self) -> EncodedImage:
         return self.images[0]
 
+    @property
+    def encoded(self) -> list[bytes]:
+        """Images as sent by WebUI"""
+        return [v.data for v in self.images]
+
 
 
 
 class WebUIApi():
-    def __init__(self, host = "localhost", port = 7860):
+    def __init__(self, host = "localhost", port = 7860, **kwargs):
         self.models: list[SDModel] = []
-        self.upscalers = []
-        self.configure(host,port)
-
-    def configure(self, host = "localhost", port = 7860):
+        self.samplers: list[SDSampler] = []
+        self.upscalers: list[SDUpscaler] = []
+        self._upscaler_index: tuple[list, dict] = (None, {})
+        self.current_model: Optional[str] = None #title of loaded checkpoint
+        self.discovered_at = 0.0
+        self._discovery_lock = asyncio.Lock()
+        self._discovery_task: Optional[asyncio.Task] = None
+        self.coalescer = RequestCoalescer()
+        self._background: set[asyncio.Task] = set()
+        self._posts = 0 #generation requests of ours in flight on the node
+        self.progress = ProgressHub(self) #one /progress poller per node, shared by all jobs
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.configure(host, port, **kwargs)
+
+    def configure(self, host = "localhost", port = 7860, pool_limit = 4, dns_ttl = 300, keepalive = 60, connect_timeout = 10, read_timeout = 600, discovery_ttl = 300, cache: ImageCache = None, decode_executor: Executor = None, decode_threshold = 64 * 1024, omit_defaults = False, interrupt_on_cancel = True):
+        """Connection pool settings are applied on the next `open()`"""
         self.host = host
         self.port = port
         self.baseurl = f'http://{host}:{port}/sdapi/v1'
-        self.timeout = aiohttp.ClientTimeout(total=9999)
+
+        self.pool_limit = pool_limit
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        #no total limit: generation time depends on the queue of the webui itself
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.discovery_ttl = discovery_ttl
+        self.cache = cache
+        #answers bigger than threshold are parsed in executor (None - default thread pool, can be process pool)
+        self.decode_executor = decode_executor
+        self.decode_threshold = decode_threshold
+        self.omit_defaults = omit_defaults #don't send fields equal to WebUI defaults
+        self.interrupt_on_cancel = interrupt_on_cancel #call /interrupt when running request is cancelled
+
+    @property
+    def size(self) -> int:
+        """Jobs the node runs at once"""
+        return 1
+
+    async def open(self) -> aiohttp.ClientSession:
+        """Opens shared keep-alive session. Safe to call many times"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.pool_limit,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive
+            )
+            self.session = aiohttp.ClientSession(timeout=self.timeout, connector=connector)
+        return self.session
+
+    async def close(self):
+        self.stop_discovery()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
             
-    def __recieve_models(self) -> list[SDModel]:
-        response = requests.get(url=f'{self.baseurl}/sd-models')
-        if response.status_code != 200:
-            raise RuntimeError(f"Error getting models. Status: {response.status_code} {response.text}")
-        models = response.json()
+    async def _get_json(self, path:str):
+        session = await self.open()
+        async with session.get(url=f'{self.baseurl}/{path}') as response:
+            if response.status != 200:
+                raise RuntimeError(f"Error getting {path}. Status: {response.status} {await response.text()}")
+            return await response.json()
+
+    async def __recieve_models(self) -> list[SDModel]:
+        models = await self._get_json("sd-models")
         result = []
         for v in models:
             try:
                 model = SDModel(
                     title=v["title"],
                     mdl_name=v["model_name"],
-                    hash=v["hash"],
-                    sha256=v["sha256"],
+                    hash=v.get("hash"),
+                    sha256=v.get("sha256"),
                     filename=v["filename"],
-                    config=v["config"]
+                    config=v.get("config")
                 )
                 result.append(model)
+            except (ValidationError, KeyError) as E:
+                logger.error(f"Error validating model {v.get('title') or 'Undefined'}. Maybe model broken?\n{E}")
+        return result
+
+    async def __recieve_samplers(self) -> list[SDSampler]:
+        result = []
+        for v in await self._get_json("samplers"):
+            try:
+                result.append(SDSampler(**v))
             except ValidationError as E:
-                logger.error(f"Error validating model {v['title'] or 'Undefined'}. Maybe model broken?\n{E}")
+                logger.error(f"Error validating sampler {v.get('name') or 'Undefined'}\n{E}")
         return result
 
-    #TODO    
-    def __recieve_samplers(self) -> list:
-        pass
-    
-    def update_models(self):
-        self.models = self.__recieve_models()
+    async def __recieve_upscalers(self) -> list[SDUpscaler]:
+        result = []
+        for v in await self._get_json("upscalers"):
+            try:
+                result.append(SDUpscaler(**v))
+            except ValidationError as E:
+                logger.error(f"Error validating upscaler {v.get('name') or 'Undefined'}\n{E}")
+        return result
+
+    async def __recieve_current_model(self) -> Optional[str]:
+        return (await self._get_json("options")).get("sd_model_checkpoint")
+
+    def discovery_expired(self) -> bool:
+        return time.monotonic() - self.discovered_at > self.discovery_ttl
+
+    async def update_models(self, force = False):
+        """Fetches models, samplers and upscalers concurrently. Cached for `discovery_ttl` seconds"""
+        async with self._discovery_lock:
+            if not force and not self.discovery_expired():
+                return
+
+            models, samplers, upscalers, current_model = await asyncio.gather(
+                self.__recieve_models(),
+                self.__recieve_samplers(),
+                self.__recieve_upscalers(),
+                self.__recieve_current_model(),
+                return_exceptions=True
+            )
+
+            #keep previous values of failed parts, so one bad endpoint doesn't wipe everything
+            failed = False
+            for name, value in (("models", models), ("samplers", samplers), ("upscalers", upscalers), ("current_model", current_model)):
+                if isinstance(value, BaseException):
+                    logger.error(f"Error updating {name} from {self.host}:{self.port}: {value}")
+                    failed = True
+                else:
+                    setattr(self, name, value)
+
+            if not failed:
+                self.discovered_at = time.monotonic()
+
+    async def __discovery_loop(self):
+        while True:
+            try:
+                await self.update_models(force=True)
+            except Exception as E:
+                logger.error(f"Error in discovery loop: {E}")
+            await asyncio.sleep(self.discovery_ttl)
+
+    def start_discovery(self):
+        """Starts background refresh of models/samplers/upscalers"""
+        if self._discovery_task is None or self._discovery_task.done():
+            self._discovery_task = asyncio.create_task(self.__discovery_loop())
+
+    def stop_discovery(self):
+        if self._discovery_task is not None:
+            self._discovery_task.cancel()
+            self._discovery_task = None
 
     def get_models(self) -> list[SDModel]:
         return self.models
 
-        
-        
-
+    def get_samplers(self) -> list[SDSampler]:
+        return self.samplers
+
+    def validate_sampler(self, name:str) -> bool:
+        """Checks sampler name locally. Unknown list (discovery not done yet) passes everything"""
+        if not name or not self.samplers:
+            return True
+        return any(name == v.name or name in v.aliases for v in self.samplers)
+
+    def model_hash(self, params) -> Optional[str]:
+        """Hash of the checkpoint that will render `params`. None if unknown"""
+        title = (params.override_settings or {}).get("sd_model_checkpoint") or self.current_model
+        if not title:
+            return None
+        for v in self.models:
+            if title in (v.title, v.mdl_name, v.hash):
+                return v.sha256 or v.hash
+        return None
+
+    def _check_samplers(self, params):
+        for name in (params.sampler_name, getattr(params, "hr_sampler_name", "")):
+            if not self.validate_sampler(name):
+                raise ValueError(f"Unknown sampler: {name}")
 
     async def _to_api_result(self, response) -> WebUIApiResult:
         if response.status != 200:
-            raise RuntimeError(response.status, await response.text())
-        
-        r = await response.json()
-        images = []
-        if 'images' in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(i))) for i in r['images']]
-        elif 'image' in r.keys():
-            images = [Image.open(io.BytesIO(base64.b64decode(r['image'])))]
+            raise WebUIHTTPError(response.status, await response.text())
         
-        info = ''
-        if 'info' in r.keys():
-            try:
-                info = json.loads(r['info'])
-            except:
-                info = r['info']
-        elif 'html_info' in r.keys():
-            info = r['html_info']
-
-        parameters = ''
-        if 'parameters' in r.keys():
-            parameters = r['parameters']
+        body = await response.read()
+        if len(body) > self.decode_threshold:
+            #multi-megabyte json + base64 would stall the event loop
+            loop = asyncio.get_running_loop()
+            encoded, parameters, info = await loop.run_in_executor(self.decode_executor, parse_api_response, body)
+        else:
+            encoded, parameters, info = parse_api_response(body)
 
-        return WebUIApiResult(images, parameters, info)
+        return WebUIApiResult([EncodedImage(v) for v in encoded], parameters, info)
     
     async def get_progress(self, skip_current_image = True) -> SDProgress:
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.get(url=f'{self.baseurl}/progress',params={"skip_current_image": str(skip_current_image)}) as response:
-                return SDProgress( **(await response.json()) )
+        session = await self.open()
+        async with session.get(url=f'{self.baseurl}/progress',params={"skip_current_image": str(skip_current_image)}) as response:
+            return SDProgress( **(await response.json()) )
             
-    async def get_upscalers(self):
+    async def get_upscalers(self) -> list[SDUpscaler]:
         if len(self.upscalers) < 1:
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.get(url=f'{self.baseurl}/upscalers') as response:
-                    self.upscalers = await response.json()
-                    return self.upscalers
-        else:
-            return self.upscalers
+            self.upscalers = await self.__recieve_upscalers()
+        return self.upscalers
+
+    @property
+    def upscaler_index(self) -> dict[str, int]:
+        """name: index map, rebuilt only when the upscaler list changes"""
+        if self._upscaler_index[0] is not self.upscalers:
+            self._upscaler_index = (self.upscalers, {v.name: i for i, v in reversed(list(enumerate(self.upscalers)))})
+        return self._upscaler_index[1]
     
     async def upscaler_by_name(self, name):
-        upscaler_id = -1
-        ids = 0
-        for v in await self.get_upscalers():
-            if v["name"] == name:
-                upscaler_id = ids
-                break
-            ids+=1
-        return upscaler_id
+        await self.get_upscalers()
+        return self.upscaler_index.get(name, -1)
 
     
-    async def txt2img(self, params: txt2img_params) -> WebUIApiResult:
-        payload = params.to_dict()
-
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.post(url=f'{self.baseurl}/txt2img', json=payload) as response:
+    async def interrupt(self):
+        """Stops current generation on the node"""
+        session = await self.open()
+        async with session.post(url=f'{self.baseurl}/interrupt') as response:
+            if response.status != 200:
+                logger.error(f"Error interrupting {self.host}:{self.port}. Status: {response.status}")
+
+    async def __interrupt_if_running(self, task_id:str, alone:bool):
+        """
+        /interrupt has no job id and stops whatever the node renders,
+        so only call it when the running job is provably ours
+        """
+        try:
+            progress = await self.get_progress()
+            if progress.current_task is not None:
+                ours = progress.current_task == task_id
+            else:
+                #older WebUI doesn't report task id: only our single request with an active job is safe
+                ours = alone and progress.state is not None and progress.state.get("job_count", 0) > 0
+            if ours:
+                await self.interrupt()
+        except Exception as E:
+            logger.error(f"Error interrupting {self.host}:{self.port}: {E}")
+
+    async def _post(self, path:str, payload:dict) -> WebUIApiResult:
+        session = await self.open()
+        task_id = None
+        if self.interrupt_on_cancel:
+            task_id = f"task({uuid.uuid4().hex})"
+            payload = {**payload, "force_task_id": task_id}
+        self._posts += 1
+        try:
+            async with session.post(url=f'{self.baseurl}/{path}', json=payload) as response:
                 return await self._to_api_result(response)
-            
-    async def img2img(self, params: img2img_params) -> WebUIApiResult:
-        payload = params.to_dict()
+        except asyncio.CancelledError:
+            #dropped connection doesn't stop WebUI, tell it explicitly
+            if task_id is not None:
+                task = asyncio.create_task(self.__interrupt_if_running(task_id, alone=self._posts == 1))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            raise
+        finally:
+            self._posts -= 1
+
+    async def _cached_post(self, path:str, payload:dict, params, params_hash:str) -> WebUIApiResult:
+        model_hash = self.model_hash(params) if self.cache is not None else None
+        if model_hash is None:
+            return await self._post(path, payload)
+
+        key = ImageCache.make_key(model_hash, params_hash, params.seed)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            encoded, parameters, info = cached
+            return WebUIApiResult([EncodedImage(v) for v in encoded], parameters, info)
+
+        result = await self._post(path, payload)
+        if result.encoded:
+            try:
+                await self.cache.put(key, result.encoded, result.parameters, result.info)
+            except OSError as E:
+                logger.error(f"Error caching image: {E}")
+        return result
 
-        async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            async with session.post(url=f'{self.baseurl}/img2img', json=payload) as response:
-                return await self._to_api_result(response)
+    async def _generate(self, path:str, params) -> WebUIApiResult:
+        self._check_samplers(params)
+        payload = params.to_dict(self.omit_defaults)
+
+        if not params.is_deterministic():
+            return await self._post(path, payload)
+        #identical concurrent requests share one job, finished ones are served from cache
+        params_hash = payload_key(payload)
+        return await self.coalescer.run(f"{path}:{params_hash}", lambda: self._cached_post(path, payload, params, params_hash))
+
+    async def txt2img(self, params: txt2img_params, on_progress: ProgressCallback = None, preview = False) -> WebUIApiResult:
+        """
+        Args:
+            on_progress: Receives /progress of this node while the job runs, see ProgressHub
+            preview: Also pass downscaled current image to on_progress
+        """
+        with self.progress.subscription(on_progress, preview):
+            return await self._generate("txt2img", params)
             
-    async def txt2img_sdupscale(self, params: txt2img_sdupscale_params) -> WebUIApiResult:
-        response = await self.txt2img(params)
-
+    async def img2img(self, params: img2img_params, on_progress: ProgressCallback = None, preview = False) -> WebUIApiResult:
+        with self.progress.subscription(on_progress, preview):
+            return await self._generate("img2img", params)
+            
+    async def sdupscale_image(self, img: EncodedImage, params: txt2img_sdupscale_params) -> EncodedImage:
+        """Upscales one image with "SD Upscale" script using upscaler index of this node"""
         upscaler_id = await self.upscaler_by_name(params.upscaler)
         if upscaler_id < 0:
             logger.error("[txt2img_sdupscale] Argument upscaler is invalid!")
             raise ValueError("[txt2img_sdupscale] Argument upscaler is invalid!")
 
-        own_images = []
-        for img in response.images:
-            pr = img2img_params()
-            pr.init_images = [img]
-            pr.prompt = "best quality, good quality, hdr, masterpiece" #params.prompt
-            pr.negative_prompt = "(worst quality, low quality:1.4), (blurry:1.2), (lowres), (deformed, distorted, disfigured:1.3), (bad hands:1.1), jpeg compression, bad image" #params.negative_prompt
-            pr.steps = 15
-            pr.width = params.width
-            pr.height = params.height
-            pr.batch_size = 3
-            pr.denoising_strength = 0.3
-            pr.cfg_scale = params.cfg_scale
-
-            pr.script_name = "SD Upscale"
-            pr.script_args = ["_", params.overlap, upscaler_id, params.upscale_factor]
-
-            # for k in dir(pr):
-            #     if not k.startswith("__"):
-            #         print("\t ", k, str(getattr(pr,k)))
-
-
-            img2img_result = await self.img2img(pr)
-            own_images.append(img2img_result.image)
-
+        result = await self.img2img(sdupscale_params(img, params, upscaler_id))
+        return result.image
+            
+    async def txt2img_sdupscale(self, params: txt2img_sdupscale_params, on_image: ImageProgress = None) -> WebUIApiResult:
+        response = await self.txt2img(params)
+        own_images = await gather_upscales([lambda img=img: self.sdupscale_image(img, params) for img in response.images], on_image)
         return WebUIApiResult(own_images,response.parameters,response.info)
     
 if __name__ == "__main__":
@@ -349,8 +714,9 @@ if __name__ == "__main__":
 
         api = WebUIApi()
         try:
-            api.update_models()
+            await api.update_models()
             pprint(api.get_models())
+            pprint(api.get_samplers())
 
             prompt = "a beautiful girl"
             negative_prompt = ""
@@ -368,5 +734,7 @@ if __name__ == "__main__":
 
         except Exception as E:
             logger.error(f"Error updating models: {E}")
+        finally:
+            await api.close()
 
     asyncio.run(main())
@@ -1,23 +1,155 @@
 from PIL import Image
 from io import BytesIO
 from math import floor
+from dataclasses import dataclass
+from typing import Optional, Union
 
+import asyncio
 import base64
 import logging
+import threading
 
 logger = logging.getLogger("telebot")
 
-def ImageToBytes(img: Image.Image):
-    img_byte_arr = BytesIO()
-    img_byte_arr.name = 'image.png'
-    img.save(img_byte_arr, format="PNG")
-    img_byte_arr.seek(0)
-    return img_byte_arr.getvalue()
-
-def ImageToBase64(image: Image.Image):
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_base64 = 'data:image/png;base64,' + str(base64.b64encode(buffered.getvalue()), 'utf-8')
+#magic bytes of formats WebUI and image providers return
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF8", "GIF"),
+)
+
+def DetectFormat(data: bytes) -> Optional[str]:
+    for signature, fmt in _SIGNATURES:
+        if data.startswith(signature):
+            return fmt
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+_MIME = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif"}
+
+def FormatExtension(fmt: Optional[str]) -> str:
+    return _EXTENSIONS.get(fmt, "png")
+
+
+@dataclass(frozen=True, slots=True)
+class EncodeOptions():
+    """
+    Output encoding of an image.
+    `max_bytes` > 0 downscales the image until it fits, but not below `min_side` pixels on the long side
+    """
+    format: str = "PNG"
+    quality: int = 90
+    max_bytes: int = 0
+    min_side: int = 256
+
+    def save_params(self) -> dict:
+        if self.format == "JPEG":
+            return {"quality": self.quality, "optimize": True}
+        if self.format == "WEBP":
+            return {"quality": self.quality, "method": 4}
+        return {}
+
+PNG = EncodeOptions()
+
+
+def _encode(img: Image.Image, options: EncodeOptions) -> bytes:
+    if options.format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buf = BytesIO()
+    img.save(buf, format=options.format, **options.save_params())
+    return buf.getvalue()
+
+def EncodeImage(img: Image.Image, options: EncodeOptions) -> bytes:
+    """Encodes image, downscaling it to fit `options.max_bytes`. Blocking, run in a thread"""
+    data = _encode(img, options)
+    while 0 < options.max_bytes < len(data) and max(img.size) > options.min_side:
+        #size of encoded image is roughly proportional to the pixel count
+        scale = max((options.max_bytes / len(data)) ** 0.5 * 0.95, options.min_side / max(img.size))
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        data = _encode(img, options)
+    return data
+
+
+class EncodedImage():
+    """
+    Image kept as encoded bytes. Pixels are decoded only when something asks for them,
+    saving in the same format just writes the bytes back.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.format = DetectFormat(data)
+        self._image: Optional[Image.Image] = None
+        self._encoded: dict[EncodeOptions, bytes] = {} #re-encoded versions, one per options
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_base64(cls, data: str) -> "EncodedImage":
+        if data.startswith("data:"):
+            data = data.split(",", 1)[1]
+        return cls(base64.b64decode(data))
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.data))
+            self._image.load()
+        return self._image
+
+    @property
+    def size(self) -> tuple[int, int]:
+        if self._image is not None:
+            return self._image.size
+        #only reads the header
+        with Image.open(BytesIO(self.data)) as img:
+            return img.size
+
+    def save(self, fp, format: str = None, **params):
+        """Same as PIL `Image.save`, without re-encoding when the format matches"""
+        if (format is None or format.upper() == self.format) and not params and self.format is not None:
+            if isinstance(fp, (str, bytes)) or hasattr(fp, "__fspath__"):
+                with open(fp, "wb") as f:
+                    f.write(self.data)
+            else:
+                fp.write(self.data)
+            return
+        self.image.save(fp, format=format, **params)
+
+    def show(self):
+        self.image.show()
+
+    def _fits(self, options: EncodeOptions) -> bool:
+        return options.format == self.format and (options.max_bytes <= 0 or len(self.data) <= options.max_bytes)
+
+    def encode_sync(self, options: EncodeOptions = PNG) -> bytes:
+        """Bytes in the requested format, original bytes if they already fit. Result is cached per options"""
+        if self._fits(options):
+            return self.data
+        with self._lock:
+            data = self._encoded.get(options)
+            if data is None:
+                data = self._encoded[options] = EncodeImage(self.image, options)
+        return data
+
+    async def encode(self, options: EncodeOptions = PNG) -> bytes:
+        if self._fits(options):
+            return self.data
+        if options in self._encoded:
+            return self._encoded[options]
+        return await asyncio.to_thread(self.encode_sync, options)
+
+
+def ImageToBytes(img: Union[Image.Image, EncodedImage], options: EncodeOptions = PNG):
+    if isinstance(img, EncodedImage):
+        return img.encode_sync(options)
+    return EncodeImage(img, options)
+
+def ImageToBase64(image: Union[Image.Image, EncodedImage], options: EncodeOptions = PNG):
+    data = ImageToBytes(image, options)
+    img_base64 = f'data:{_MIME.get(DetectFormat(data), "image/png")};base64,' + str(base64.b64encode(data), 'utf-8')
     return img_base64
 
 def RoundTo8(num):
@@ -5,9 +5,18 @@ from discord.ext import commands
 import os
 from typing import Dict, List
 from dotenv import load_dotenv
-from lib.ai_client import G4FClient
+from lib.ai_client import G4FClient, DEFAULT_IMAGE_PRESETS
+from lib.llm_cache import LLMCache
+from lib.rate_limiter import RateLimiter
+from dataclasses import replace
+from lib.sd_api.balancer import WebUIPool
+from lib.sd_api.sd_api import APIQueue, JobCancelled, MaxQueueReached
+from lib.sd_api.image_cache import ImageCache
 from lib.bunker.discord_bunker_game import DiscordBunkerGame
+from lib.bunker.bunker_pool import BunkerPool
 from lib.bunker.player import Player
+from lib.bunker.game_config import GameConfig
+from lib.bunker.discord_updates import ThrottledMessageEditor, image_file
 from lib.logging_config import setup_logging
 from io import BytesIO
 
@@ -21,23 +30,96 @@ TOKEN = os.getenv('DISCORD_TOKEN')
 # Proxy configuration
 PROXY_URL = os.getenv('PROXY_URL')
 
+# Stable Diffusion WebUI серверы через запятую: host1:7860,host2:7860
+SD_HOSTS = os.getenv('SD_HOSTS', 'localhost:7860')
+
+# Кэш сгенерированных изображений на диске
+SD_CACHE_DIR = os.getenv('SD_CACHE_DIR')
+SD_CACHE_MB = int(os.getenv('SD_CACHE_MB', '1024'))
+sd_cache = ImageCache(SD_CACHE_DIR, SD_CACHE_MB * 1024 * 1024) if SD_CACHE_DIR else None
+
+# Дедлайн одной попытки SD и задержка, после которой параллельно запускается запасной провайдер (секунды)
+SD_TIMEOUT = float(os.getenv('SD_TIMEOUT')) if os.getenv('SD_TIMEOUT') else None
+SD_HEDGE_AFTER = float(os.getenv('SD_HEDGE_AFTER')) if os.getenv('SD_HEDGE_AFTER') else None
+
+# Шаги и сэмплер для всех пресетов изображений (разрешение задаётся пресетом)
+SD_STEPS = int(os.getenv('SD_STEPS', '28'))
+SD_SAMPLER = os.getenv('SD_SAMPLER', 'Euler a')
+image_presets = {name: replace(preset, steps=SD_STEPS, sampler_name=SD_SAMPLER) for name, preset in DEFAULT_IMAGE_PRESETS.items()}
+
+# Кэш ответов LLM: в памяти, а с LLM_CACHE_PATH ещё и в SQLite
+# LLM_CACHE_VARIETY - сколько разных ответов хранить на один запрос (выдаётся случайный)
+llm_cache = LLMCache(
+    path=os.getenv('LLM_CACHE_PATH'),
+    ttl=float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600))),
+    variety=int(os.getenv('LLM_CACHE_VARIETY', '3'))
+)
+
 # Настройка интентов
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.reactions = True
 
-from g4f.Provider import RetryProvider, ImageLabs, Free2GPT
+import g4f.Provider
+from g4f.Provider import ImageLabs
+
+# Провайдеры LLM через запятую: запрос идёт самому быстрому из работающих
+LLM_PROVIDERS = [getattr(g4f.Provider, name.strip()) for name in os.getenv('LLM_PROVIDERS', 'Free2GPT').split(',') if name.strip()]
+# Провайдеры, которые справляются с пакетными JSON запросами (внешность нескольких персонажей сразу)
+LLM_BATCH_PROVIDERS = [name.strip() for name in os.getenv('LLM_BATCH_PROVIDERS', 'Free2GPT').split(',') if name.strip()]
+
+# Общий лимит запросов к LLM для всех игр: LLM_CONCURRENCY запросов одновременно к каждому провайдеру
+# и не больше LLM_RPM запросов в минуту (пусто - без ограничения частоты)
+llm_limiter = RateLimiter(
+    concurrency=int(os.getenv('LLM_CONCURRENCY', '4')),
+    rpm=float(os.getenv('LLM_RPM')) if os.getenv('LLM_RPM') else None
+)
+
 ai_client = G4FClient(
     model="gemini-1.5-flash", 
-    provider=RetryProvider([Free2GPT], shuffle=False),
+    provider=LLM_PROVIDERS,
     image_model="sdxl-turbo",
     image_provider=ImageLabs,
     # proxies=PROXY_URL
+    sd_api=WebUIPool.from_hosts(SD_HOSTS, cache=sd_cache),
+    stable_seeds=sd_cache is not None,
+    image_presets=image_presets,
+    llm_cache=llm_cache,
+    llm_limiter=llm_limiter,
+    batch_requests=LLM_BATCH_PROVIDERS,
+    sd_timeout=SD_TIMEOUT,
+    hedge_after=SD_HEDGE_AFTER
 )
 
+# Готовые бункеры для мгновенного старта игры
+bunker_pool = BunkerPool(
+    ai_client,
+    themes=GameConfig.BUNKER_POOL_THEMES,
+    theme_size=GameConfig.BUNKER_POOL_THEME_SIZE,
+    random_size=GameConfig.BUNKER_POOL_RANDOM_SIZE,
+    ttl=GameConfig.BUNKER_POOL_TTL,
+    max_bytes=GameConfig.BUNKER_POOL_MAX_MB * 1024 * 1024
+) if GameConfig.BUNKER_POOL_ENABLED else None
+
+class BunkerBot(commands.Bot):
+    """Бот с управлением жизненным циклом AI клиента"""
+
+    async def setup_hook(self):
+        await ai_client.open()
+        if bunker_pool is not None:
+            bunker_pool.start()
+
+    async def close(self):
+        try:
+            if bunker_pool is not None:
+                await bunker_pool.stop()
+            await ai_client.close()
+        finally:
+            await super().close()
+
 # Инициализация бота
-bot = commands.Bot(command_prefix='/', intents=intents)
+bot = BunkerBot(command_prefix='/', intents=intents)
 active_games: Dict[int, DiscordBunkerGame] = {}  # Словарь для хранения активных игр
 
 @bot.event
@@ -93,7 +175,7 @@ async def start_game(interaction: discord.Interaction, theme: str = None):
         game = DiscordBunkerGame(ai_client, interaction.user.id, channel.id)
         
         # Генерация бункера до начала игры
-        async for status_msg in game.generate_bunker(theme = theme):
+        async for status_msg in game.generate_bunker(theme = theme, pool = bunker_pool):
             msg = await msg.edit(content=f"{msg.content}\n-# {status_msg}")
         await msg.edit(content=f"## Генерация бункера завершена")
         
@@ -124,7 +206,7 @@ async def start_game(interaction: discord.Interaction, theme: str = None):
         
         # Если есть изображение бункера, добавляем его
         if game.bunker.image:
-            bunker_file = game.bunker.get_image_file()
+            bunker_file = await game.bunker.get_image_file()
             await channel.send(file=bunker_file)
         
         await channel.send(embed=bunker_embed)
@@ -354,6 +436,40 @@ class AdminControlView(discord.ui.View):
             logger.error(f"Ошибка при начале голосования: {e}", exc_info=True)
             await interaction.followup.send(f"Произошла ошибка: {e}", ephemeral=True)
     
+    @discord.ui.button(label="Портреты всех игроков", style=discord.ButtonStyle.secondary, custom_id="portrait_all", row=2)
+    async def portrait_all_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Обработчик кнопки пакетной генерации портретов всех игроков"""
+        try:
+            # Отложенный ответ
+            await interaction.response.defer(ephemeral=True)
+
+            if self.game.status != "running":
+                await interaction.followup.send("Игра еще не запущена или уже завершена!", ephemeral=True)
+                return
+
+            # Один пакетный запрос к Stable Diffusion вместо отдельного на каждого игрока
+            await interaction.followup.send("🔄 Генерирую портреты всех игроков...", ephemeral=True)
+            players = await self.game.generate_portraits()
+
+            for player in players:
+                user = bot.get_user(player.id)
+                if not user:
+                    continue
+                try:
+                    dm_channel = await user.create_dm()
+                    embed, file = await portrait_message(player)
+                    await dm_channel.send(embed=embed, file=file)
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке портрета игроку {player.name}: {e}", exc_info=True)
+
+            await interaction.followup.send(f"Портреты сгенерированы: {len(players)}.", ephemeral=True)
+            logger.info(f"Пакетно сгенерировано {len(players)} портретов в канале {self.game.channel_id}")
+        except JobCancelled:
+            await interaction.followup.send("Генерация портретов отменена: игра завершена.", ephemeral=True)
+        except Exception as e:
+            logger.error(f"Ошибка при пакетной генерации портретов: {e}", exc_info=True)
+            await interaction.followup.send(f"Произошла ошибка: {e}", ephemeral=True)
+
     @discord.ui.button(label="Закончить игру", style=discord.ButtonStyle.red, custom_id="end_game", row=1)
     async def end_game_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Обработчик нажатия кнопки завершения игры"""
@@ -426,7 +542,7 @@ class AdminControlView(discord.ui.View):
                     
                     # Если есть изображение бункера, добавляем его в ЛС
                     if self.game.bunker.image:
-                        bunker_file = self.game.bunker.get_image_file()
+                        bunker_file = await self.game.bunker.get_image_file()
                         dm_channel = await user.create_dm()
                         # Добавляем описание изображения
                         bunker_image_embed = discord.Embed(
@@ -661,8 +777,8 @@ class PlayerVoteSelect(discord.ui.Select):
                     logger.error("Ошибка: игрок не найден")
                     return
                 
-                # Исключаем игрока
-                exile_player.is_active = False
+                # Исключаем игрока (заодно отменяются его генерации)
+                self.game.remove_player(exile_player.id)
                 
                 # Отправляем уведомление в общий чат
                 result_embed = discord.Embed(
@@ -813,8 +929,8 @@ class AdminVoteControlView(discord.ui.View):
                     await interaction.followup.send("Ошибка: игрок не найден", ephemeral=True)
                     return
                 
-                # Исключаем игрока
-                exile_player.is_active = False
+                # Исключаем игрока (заодно отменяются его генерации)
+                self.game.remove_player(exile_player.id)
                 
                 result_embed = discord.Embed(
                     title="🗳️ Результаты голосования",
@@ -1159,8 +1275,8 @@ class GenerateImageButton(discord.ui.Button):
             # Отложенный ответ
             await interaction.response.defer(ephemeral=True)
             
-            # Проверка, что изображение еще не сгенерировано
-            if self.used:
+            # Проверка, что изображение еще не сгенерировано (в том числе пакетно для всех игроков)
+            if self.used or self.player.portrait is not None:
                 await interaction.followup.send("Вы уже сгенерировали изображение персонажа!", ephemeral=True)
                 return
             
@@ -1183,49 +1299,82 @@ class GenerateImageButton(discord.ui.Button):
             
             # Создание промпта для генерации изображения
             logger.info(f"Генерация изображения для персонажа {self.player.name}")
-            prompt = await self.game.ai_client.generate_message([
-                {"role": "system", "content": "You are Stable Diffusion prompt generator. Always respond in English"},
-                {"role": "user", "content": f"""Generate a Stable Diffusion prompt for following person: {self.player.get_character_card()}
-Answer only with prompt, without any other text.
-Describe person with "tags" like "A woman 38 years old, blonde hair, blue eyes, etc.",
-Describe old or young, male or female, etc.
-"""}])
+            prompt = await self.player.generate_portrait_prompt(self.game.ai_client)
             
             # Генерация изображения
+            progress_message = None
+            editor = None
             try:
-                image = await self.game.ai_client.generate_image(prompt)
-                
-                # Сохраняем изображение для отправки
-                image_bytes = BytesIO()
-                image.save(image_bytes, format='PNG')
-                image_bytes.seek(0)
-                file = discord.File(image_bytes, filename='character.png')
-                
-                # Создание эмбеда с изображением
-                embed = discord.Embed(
-                    title="🎨 Изображение вашего персонажа",
-                    description=prompt,
-                    color=discord.Color.blue()
+                # Сообщение с прогрессом, обновляется не чаще лимитов Discord
+                progress_message = await interaction.followup.send("🔄 Изображение в очереди...", ephemeral=True, wait=True)
+                editor = ThrottledMessageEditor(progress_message)
+
+                async def on_progress(progress, preview):
+                    content = f"🔄 Генерация изображения: {progress.progress:.0%} (осталось ~{progress.eta_relative:.0f} с)"
+                    if preview is not None:
+                        editor.update(content=content, attachments=[discord.File(BytesIO(preview.data), filename='preview.jpg')])
+                    else:
+                        editor.update(content=content)
+
+                image = await self.game.ai_client.generate_image(
+                    prompt, uid=self.player.id, group=self.game.channel_id, priority=APIQueue.PRIORITY_LOW,
+                    on_progress=on_progress, preview=GameConfig.IMAGE_PROGRESS_PREVIEW,
+                    preset=GameConfig.CHARACTER_IMAGE_PRESET
                 )
                 
+                self.player.portrait = image
+                self.player.portrait_prompt = prompt
+
                 # Отправка изображения
+                embed, file = await portrait_message(self.player)
                 await interaction.followup.send(embed=embed, file=file)
                 
                 # Обновляем состояние кнопки на успешное
                 await self.update_button_state(interaction, success=True)
                 
                 logger.info(f"Сгенерировано изображение для персонажа игрока {self.player.name}")
+            except JobCancelled:
+                logger.info(f"Генерация изображения для игрока {self.player.name} отменена")
+                await interaction.followup.send("Генерация изображения отменена: игра завершена.", ephemeral=True)
+            except MaxQueueReached:
+                logger.info(f"Очередь изображений игрока {self.player.name} заполнена")
+                await interaction.followup.send("У вас уже есть изображения в очереди. Дождитесь их и попробуйте снова.", ephemeral=True)
+                await self.update_button_state(interaction, success=False)
             except Exception as e:
                 logger.error(f"Ошибка при генерации изображения: {e}", exc_info=True)
                 await interaction.followup.send("Произошла ошибка при генерации изображения. Попробуйте позже.", ephemeral=True)
                 # Обновляем состояние кнопки на ошибку
                 await self.update_button_state(interaction, success=False)
+            finally:
+                if editor:
+                    editor.cancel()
+                if progress_message:
+                    try:
+                        await progress_message.delete()
+                    except discord.HTTPException:
+                        pass
         except Exception as e:
             logger.error(f"Ошибка при обработке кнопки генерации изображения: {e}", exc_info=True)
             await interaction.followup.send(f"Произошла ошибка: {e}", ephemeral=True)
             # Обновляем состояние кнопки на ошибку
             await self.update_button_state(interaction, success=False)
 
+async def portrait_message(player: Player):
+    """
+    Эмбед и файл с портретом персонажа
+
+    Returns:
+        Tuple[discord.Embed, discord.File]: Эмбед с описанием и файл изображения
+    """
+    file = await image_file(player.portrait, 'character')
+
+    embed = discord.Embed(
+        title="🎨 Изображение вашего персонажа",
+        description=player.portrait_prompt,
+        color=discord.Color.blue()
+    )
+    return embed, file
+
 async def update_all_player_tables(game: DiscordBunkerGame, bot) -> None:
     """
     Обновление таблиц статусов для всех активных игроков